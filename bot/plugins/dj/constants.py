@@ -0,0 +1,3 @@
+LOOKAHEAD_KEY = 'lookahead'
+TTS_CACHE_DIR_KEY = 'tts_cache_dir'
+TTS_CACHE_SIZE_KEY = 'tts_cache_size'
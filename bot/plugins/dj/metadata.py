@@ -0,0 +1,111 @@
+from globibot.lib.helpers.cache import LRUCache
+from globibot.lib.helpers.single_flight import SingleFlight
+
+from youtube_dl import YoutubeDL
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import queries as q
+
+import asyncio
+import json
+import re
+
+URL_PATTERN = re.compile(r'^https?://', re.IGNORECASE)
+
+YTDL_INFO_OPTS = {
+    'simulate': True,
+    'default_search': 'ytsearch',
+    'noplaylist': True
+}
+
+# Only what the web interface displays and what playback needs
+INFO_FIELDS = (
+    'title', 'extractor_key', 'webpage_url', 'duration', 'thumbnail', 'uploader'
+)
+
+def normalize(query):
+    query = ' '.join(query.split())
+
+    # Video ids are case sensitive, search terms are not
+    if URL_PATTERN.match(query):
+        return query
+    return query.lower()
+
+def extract_info(query):
+    ydl = YoutubeDL(YTDL_INFO_OPTS)
+    infos = ydl.extract_info(query)
+
+    if 'entries' in infos:
+        entries = list(infos['entries'])
+        if not entries:
+            raise LookupError('No results for "{}"'.format(query))
+        infos = entries[0]
+
+    return dict((field, infos.get(field)) for field in INFO_FIELDS)
+
+class MetadataResolver:
+    '''
+    Resolves media metadata off the event loop, remembering results in memory
+    and in the database so that popular songs are only looked up once a day
+    '''
+
+    WORKERS = 4
+    CACHE_SIZE = 1024
+    TTL = 24 * 60 * 60
+
+    def __init__(self, transaction, debug):
+        self.transaction = transaction
+        self.debug = debug
+
+        self.executor = ThreadPoolExecutor(MetadataResolver.WORKERS)
+        self.cache = LRUCache(MetadataResolver.CACHE_SIZE, MetadataResolver.TTL)
+        self.pending = SingleFlight()
+
+    async def resolve(self, query):
+        key = normalize(query)
+
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+
+        infos = self.load(key)
+        if infos is not None:
+            self.cache[key] = infos
+            return infos
+
+        # Concurrent requests for the same song share a single lookup
+        return await self.pending.run(key, self.extract, key)
+
+    async def extract(self, key):
+        self.debug('Resolving: {}'.format(key))
+
+        loop = asyncio.get_event_loop()
+        infos = await loop.run_in_executor(self.executor, extract_info, key)
+
+        self.cache[key] = infos
+        self.save(key, infos)
+
+        return infos
+
+    def load(self, key):
+        with self.transaction() as trans:
+            trans.execute(
+                q.get_media_info,
+                dict(query=key, ttl=MetadataResolver.TTL)
+            )
+            row = trans.fetchone()
+
+        if row:
+            return row[0]
+
+    def save(self, key, infos):
+        with self.transaction() as trans:
+            trans.execute(
+                q.save_media_info,
+                dict(query=key, infos=json.dumps(infos))
+            )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
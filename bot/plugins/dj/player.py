@@ -1,8 +1,9 @@
-import asyncio
-
 from youtube_dl import YoutubeDL
 
 from collections import deque
+from itertools import islice
+
+import asyncio
 
 class ItemType:
     LocalFile = 1
@@ -17,6 +18,22 @@ YTDL_PLAYER_OPTS = {
     'noplaylist': True
 }
 
+# What create_ytdl_player asks youtube-dl for
+YTDL_STREAM_OPTS = dict(
+    YTDL_PLAYER_OPTS,
+    format        = 'webm[abr>0]/bestaudio/best',
+    prefer_ffmpeg = not DEFAULT_PLAYER_OPTIONS['use_avconv']
+)
+
+def stream_url(url):
+    ydl = YoutubeDL(YTDL_STREAM_OPTS)
+    info = ydl.extract_info(url, download=False)
+
+    if 'entries' in info:
+        info = info['entries'][0]
+
+    return info['url']
+
 class PlayerItem:
 
     def __init__(self, type, resource, user):
@@ -25,67 +42,182 @@ class PlayerItem:
         self.user = user
 
         self.infos = dict()
-        if self.type == ItemType.YTDLLink:
-            self.infos = self.extract_info()
-
-    async def make_player(self, voice):
+        self.loop = asyncio.get_event_loop()
+        self.resolved = asyncio.Future()
+        self.finished = asyncio.Future()
+        if self.type != ItemType.YTDLLink:
+            self.resolved.set_result(self.infos)
+
+    @property
+    def resolving(self):
+        return not self.resolved.done()
+
+    async def resolve(self, metadata):
+        try:
+            self.infos = await metadata.resolve(self.resource)
+        except Exception as e:
+            self.resolved.set_exception(e)
+            raise
+        else:
+            self.resolved.set_result(self.infos)
+
+    @property
+    def url(self):
+        # The resolved URL spares youtube-dl a second search
+        return self.infos.get('webpage_url') or self.resource
+
+    async def resolve_stream(self):
+        '''
+        The direct media URL of a link, resolved ahead of time so that only
+        ffmpeg has to be started when the item comes up
+        '''
+        if self.type != ItemType.YTDLLink:
+            return None
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, stream_url, self.url)
+
+    async def make_player(self, voice, stream=None):
         if self.type == ItemType.LocalFile:
             player = voice.create_ffmpeg_player(
                 self.resource,
+                after=self.on_player_done,
+                **DEFAULT_PLAYER_OPTIONS
+            )
+        elif stream is not None:
+            player = voice.create_ffmpeg_player(
+                stream,
+                after=self.on_player_done,
                 **DEFAULT_PLAYER_OPTIONS
             )
         elif self.type == ItemType.YTDLLink:
             player = await voice.create_ytdl_player(
-                self.resource,
+                self.url,
                 ytdl_options=YTDL_PLAYER_OPTS,
+                after=self.on_player_done,
                 **DEFAULT_PLAYER_OPTIONS
             )
 
         return player
 
-    def extract_info(self):
-        opts = {
-            'simulate': True
-        }
-        opts.update(YTDL_PLAYER_OPTS)
-        ydl = YoutubeDL(opts)
-        return ydl.extract_info(self.resource)
+    def on_player_done(self, player):
+        # Called from the player's thread once it stopped, for any reason
+        self.loop.call_soon_threadsafe(self.finish)
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
 
 class ServerPlayer:
 
-    def __init__(self, server, get_voice, get_volume):
+    IDLE_TIMEOUT = 5 * 60
+
+    def __init__(self, server, get_voice, get_volume, lookahead):
         self.server = server
         self.get_voice = get_voice
         self.get_volume = get_volume
+        self.lookahead = lookahead
 
         self.queue = asyncio.Queue()
         self.items = deque()
         self.player = None
+        self.prepared = dict()
 
-    async def start(self, on_error, on_next):
-        POLL_INTERVAL = 0.2
-
+    async def start(self, on_error, on_next, on_idle):
         while True:
-            item = await self.queue.get()
+            try:
+                item = await asyncio.wait_for(
+                    self.queue.get(),
+                    ServerPlayer.IDLE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                on_idle()
+                return
+
+            try:
+                await item.resolved
+            except Exception:
+                # Reported and discarded by whoever resolved it
+                self.queue.task_done()
+                continue
+
             on_next(item)
 
             try:
-                voice = self.get_voice(self.server)
-                self.player = await item.make_player(voice)
+                self.player = await self.make_player(item)
                 self.player.volume = self.get_volume()
                 self.player.start()
             except Exception as e:
-                on_error(e)
+                on_error(item, e)
+                item.finish()
             else:
-                while not self.player.is_done():
-                    await asyncio.sleep(POLL_INTERVAL)
+                self.prepare_ahead()
+                await item.finished
 
             self.queue.task_done()
             self.items.popleft()
 
+    async def make_player(self, item):
+        voice = await self.get_voice(self.server)
+
+        try:
+            prepared = self.prepared.pop(item)
+        except KeyError:
+            pass
+        else:
+            try:
+                stream = await prepared
+                return await item.make_player(voice, stream)
+            except Exception:
+                # Resolved from scratch below
+                pass
+
+        return await item.make_player(voice)
+
+    async def prepare(self, item):
+        await item.resolved
+        return await item.resolve_stream()
+
+    def prepare_ahead(self):
+        '''
+        Resolves the stream of the upcoming items while the current one is
+        playing
+        ffmpeg itself is only started when the item comes up: started early,
+        it would sit on an idle connection for the whole current track
+        '''
+        if self.player is None or self.player.is_done():
+            return
+
+        for item in islice(self.items, 1, 1 + self.lookahead):
+            if item not in self.prepared:
+                future = asyncio.ensure_future(self.prepare(item))
+                self.prepared[item] = future
+
+    def unprepare(self, item):
+        try:
+            future = self.prepared.pop(item)
+        except KeyError:
+            return
+
+        if future.done():
+            # Retrieved so that a failed preparation is not reported
+            if not future.cancelled():
+                future.exception()
+        else:
+            future.cancel()
+
     async def enqueue(self, item):
         self.items.append(item)
         await self.queue.put(item)
+        self.prepare_ahead()
+
+    def discard(self, item):
+        self.unprepare(item)
+
+        try:
+            self.items.remove(item)
+        except ValueError:
+            pass
 
     def skip(self):
         self.player.stop()
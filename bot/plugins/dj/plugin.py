@@ -9,6 +9,8 @@ from .handlers import VoiceHandler
 from .ws_handler import VoiceWebSocketHandler
 from .tts import TTSManager
 from .player import ServerPlayer, ItemType, PlayerItem
+from .metadata import MetadataResolver
+from . import constants as c
 
 from collections import defaultdict
 
@@ -23,7 +25,11 @@ user_data = lambda user: dict(
 )
 
 def item_data(item):
-    data = dict(resource = item.resource, user=user_data(item.user))
+    data = dict(
+        resource  = item.resource,
+        user      = user_data(item.user),
+        resolving = item.resolving
+    )
     if item.type == ItemType.LocalFile:
         data['tts'] = True
 
@@ -36,6 +42,10 @@ def required_skips_for(count):
 
 class Dj(Plugin):
 
+    DEFAULT_LOOKAHEAD = 1
+    DEFAULT_TTS_CACHE_DIR = '/tmp/globibot_tts'
+    DEFAULT_TTS_CACHE_SIZE = 64 * 1024 * 1024
+
     def load(self):
         context = dict(plugin=self, bot=self.bot)
         self.add_web_handlers(
@@ -44,12 +54,23 @@ class Dj(Plugin):
         )
 
         self.players = dict()
+        # Voice channels left by idle players, joined back on the next item
+        self.idle_channels = dict()
         self.volumes = defaultdict(lambda: 1.0)
-        self.tts = TTSManager()
+        self.tts = TTSManager(
+            self.config.get(c.TTS_CACHE_DIR_KEY, Dj.DEFAULT_TTS_CACHE_DIR),
+            self.config.get(c.TTS_CACHE_SIZE_KEY, Dj.DEFAULT_TTS_CACHE_SIZE)
+        )
+        self.metadata = MetadataResolver(self.transaction, self.debug)
+        self.lookahead = self.config.get(c.LOOKAHEAD_KEY, Dj.DEFAULT_LOOKAHEAD)
 
         self.ws_consumers = defaultdict(set)
         self.ongoing_skips = dict()
 
+    def unload(self):
+        self.metadata.shutdown()
+        self.tts.cache.shutdown()
+
     async def on_reaction_add(self, reaction, user):
         if user == self.bot.user:
             return
@@ -153,16 +174,25 @@ class Dj(Plugin):
                 del self.ongoing_skips[server_id]
 
     async def queue_tts(self, server, user, content, lang=None):
-        sound_file = self.tts.talk_in(server, content, lang)
+        sound_file = await self.tts.talk_in(server, content, lang)
 
-        await self.queue_item(
-            server,
-            user,
-            ItemType.LocalFile,
-            sound_file
-        )
+        try:
+            item = await self.queue_item(
+                server,
+                user,
+                ItemType.LocalFile,
+                sound_file
+            )
+        except:
+            self.tts.release(sound_file)
+            raise
+
+        # Kept in the cache until it has been played
+        item.finished.add_done_callback(lambda _: self.tts.release(sound_file))
 
     async def join_voice(self, channel):
+        self.idle_channels.pop(channel.server.id, None)
+
         voice = self.bot.voice_client_in(channel.server)
         if voice is None:
             await self.bot.join_voice_channel(channel)
@@ -170,32 +200,75 @@ class Dj(Plugin):
             await voice.move_to(channel)
 
     async def leave_voice(self, server):
+        self.idle_channels.pop(server.id, None)
+
         voice = self.bot.voice_client_in(server)
         if voice is not None:
             await voice.disconnect()
 
     async def queue_item(self, server, user, type, resource):
+        item = PlayerItem(type, resource, user)
+
+        player = self.get_player(server)
+        await player.enqueue(item)
+        self.notify_ws_queue(server, item)
+
+        if item.resolving:
+            self.run_async(self.resolve_item(server, item))
+
+        return item
+
+    async def resolve_item(self, server, item):
         try:
-            item = PlayerItem(type, resource, user)
+            await item.resolve(self.metadata)
         except Exception as e:
-            self.notify_ws_error(server, str(e), resource)
-        else:
-            player = self.get_player(server)
-            await player.enqueue(item)
-            self.notify_ws_queue(server, item)
+            self.get_player(server).discard(item)
+            self.notify_ws_error(server, str(e), item.resource)
+
+        self.notify_ws(server, self.server_queue_data(server))
 
     def get_player(self, server):
         try:
             player = self.players[server.id]
         except KeyError:
             get_volume = lambda: self.volumes[server.id]
-            player = ServerPlayer(server, self.bot.voice_client_in, get_volume)
+            player = ServerPlayer(
+                server, self.voice_for, get_volume, self.lookahead
+            )
             self.players[server.id] = player
+            on_error = lambda item, e: self.on_player_error(server, item, e)
             on_next = lambda item: self.notify_ws_next(server, item)
-            self.run_async(player.start(self.error, on_next))
+            on_idle = lambda: self.tear_down_player(server)
+            self.run_async(player.start(on_error, on_next, on_idle))
 
         return player
 
+    async def voice_for(self, server):
+        voice = self.bot.voice_client_in(server)
+        if voice is not None:
+            return voice
+
+        try:
+            channel = self.idle_channels.pop(server.id)
+        except KeyError:
+            raise LookupError('Not in a voice channel, join one first')
+
+        self.debug('Joining {} back in {}'.format(channel, server))
+        return await self.bot.join_voice_channel(channel)
+
+    def on_player_error(self, server, item, error):
+        self.error('Could not play {}: {}'.format(item.resource, error))
+        self.notify_ws_error(server, str(error), item.resource)
+
+    def tear_down_player(self, server):
+        self.debug('Tearing down idle player in {}'.format(server))
+        del self.players[server.id]
+
+        voice = self.bot.voice_client_in(server)
+        if voice is not None:
+            self.idle_channels[server.id] = voice.channel
+            self.run_async(voice.disconnect())
+
     def notify_ws_next(self, server, item):
         data = dict(type='next', playing=item_data(item))
 
@@ -0,0 +1,14 @@
+get_media_info = '''
+    select      infos
+        from    dj_media_info
+        where   query = %(query)s
+            and resolved_at > (now() at time zone 'utc') - %(ttl)s * interval '1 second'
+'''
+
+save_media_info = '''
+    insert into dj_media_info (query, infos)
+    values                    (%(query)s, %(infos)s)
+    on conflict               (query)
+    do update set   infos       = %(infos)s,
+                    resolved_at = (now() at time zone 'utc')
+'''
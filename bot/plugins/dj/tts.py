@@ -1,7 +1,13 @@
+from globibot.lib.helpers.single_flight import SingleFlight
+
 from gtts import gTTS
 
-from tempfile import mktemp
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+import asyncio
+import os
 
 LANGUAGES = (
     ('af', 'afrikaans'), ('sq', 'albanian'), ('ar', 'arabic'),
@@ -28,18 +34,127 @@ DEFAULT_LANGUAGE = 'en-us'
 LANGUAGES_BY_SYMBOLS = dict(LANGUAGES)
 SYMBOLS_BY_LANGUAGES = dict((lang, sym) for sym, lang in LANGUAGES)
 
-def make_tts_file(content, lang):
-    fp = mktemp()
+PART_SUFFIX = '.part'
+
+def normalize(content):
+    return ' '.join(content.split())
+
+def make_tts_file(path, content, lang):
+    # Written aside first so that a failed synthesis never leaves a
+    # truncated file in the cache
+    part_path = path + PART_SUFFIX
 
     tts = gTTS(text=content, lang=lang)
-    tts.save(fp)
+    tts.save(part_path)
+
+    os.rename(part_path, path)
+
+class TTSCache:
+    '''
+    Content addressed store of synthesized speech that evicts the least
+    recently used files once it grows past `max_size` bytes
+    Files handed out by get are pinned until they are released, so that
+    files waiting to be played are never evicted
+    '''
+
+    WORKERS = 2
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.executor = ThreadPoolExecutor(TTSCache.WORKERS)
+        self.files = OrderedDict()
+        self.size = 0
+        self.pending = SingleFlight()
+        self.pinned = Counter()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        paths = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+        ]
+
+        for path in sorted(paths, key=os.path.getmtime):
+            if path.endswith(PART_SUFFIX):
+                os.remove(path)
+            else:
+                self.add(path)
+
+        self.evict()
+
+    def path_for(self, content, lang):
+        key = '{}\n{}'.format(lang, content).encode('utf-8')
+        name = '{}.mp3'.format(sha256(key).hexdigest())
+
+        return os.path.join(self.directory, name)
 
-    return fp
+    async def get(self, content, lang):
+        content = normalize(content)
+        path = self.path_for(content, lang)
+        self.pinned[path] += 1
+
+        if path in self.files:
+            self.files.move_to_end(path)
+            # Keeps the recency order across restarts
+            os.utime(path)
+            return path
+
+        try:
+            return await self.pending.run(path, self.synthesize, path, content, lang)
+        except:
+            self.release(path)
+            raise
+
+    def release(self, path):
+        self.pinned[path] -= 1
+        if self.pinned[path] <= 0:
+            del self.pinned[path]
+
+    async def synthesize(self, path, content, lang):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(
+            self.executor,
+            make_tts_file, path, content, lang
+        )
+
+        self.add(path)
+        self.evict()
+
+        return path
+
+    def add(self, path):
+        size = os.path.getsize(path)
+
+        self.files[path] = size
+        self.size += size
+
+    def evict(self):
+        evictable = [path for path in self.files if path not in self.pinned]
+
+        for path in evictable:
+            if self.size <= self.max_size:
+                break
+
+            size = self.files.pop(path)
+            self.size -= size
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
 
 class TTSManager:
 
-    def __init__(self):
+    def __init__(self, cache_dir, cache_size):
         self.server_languages = defaultdict(lambda: DEFAULT_LANGUAGE)
+        self.cache = TTSCache(cache_dir, cache_size)
 
     def set_server_language(self, server, lang):
         if lang in LANGUAGES_BY_SYMBOLS:
@@ -52,6 +167,9 @@ class TTSManager:
         self.server_languages[server.id] = sym
         return True
 
-    def talk_in(self, server, content, lang=None):
+    async def talk_in(self, server, content, lang=None):
         lang = lang or self.server_languages[server.id]
-        return make_tts_file(content, lang)
+        return await self.cache.get(content, lang)
+
+    def release(self, path):
+        self.cache.release(path)
@@ -0,0 +1,118 @@
+from globibot.lib.helpers.single_flight import SingleFlight
+
+from io import BytesIO
+from hashlib import sha256
+from collections import Counter
+
+import asyncio
+
+TAG_PREFIX = 'globibot_build'
+
+class BuildService:
+    '''
+    Builds environment images, addressed by the content of their Dockerfile
+    Identical Dockerfiles share a single image, whoever built them, and
+    concurrent builds of the same Dockerfile are only run once
+    '''
+
+    CONCURRENCY = 2
+    GC_INTERVAL = 60 * 60
+
+    def __init__(self, docker, referenced_images, debug):
+        self.docker = docker
+        self.referenced_images = referenced_images
+        self.debug = debug
+
+        self.semaphore = asyncio.Semaphore(BuildService.CONCURRENCY)
+        self.builds = SingleFlight()
+        # Images handed out by build that are not referenced in the database
+        # yet, collecting them would pull them from under their environment
+        self.pinned = Counter()
+
+    @staticmethod
+    def image_name(dockerfile):
+        digest = sha256(dockerfile.encode('utf8')).hexdigest()
+        return '{}_{}'.format(TAG_PREFIX, digest[:32])
+
+    async def build(self, dockerfile, stream):
+        '''
+        Returns the image built from the Dockerfile, or None if the build
+        errored
+        The returned image is pinned until release is called with it, once it
+        has been saved
+        stream is awaited with the build output when this call is the one
+        running the build, and tells whether it succeeded
+        '''
+        image = BuildService.image_name(dockerfile)
+        self.pinned[image] += 1
+
+        try:
+            built = await self.build_image(image, dockerfile, stream)
+        except:
+            self.release(image)
+            raise
+
+        if built is None:
+            self.release(image)
+
+        return built
+
+    async def build_image(self, image, dockerfile, stream):
+        if image not in self.builds and await self.docker.has_image(image):
+            return image
+
+        return await self.builds.run(
+            image, self.run_build, image, dockerfile, stream
+        )
+
+    def release(self, image):
+        self.pinned[image] -= 1
+        if self.pinned[image] <= 0:
+            del self.pinned[image]
+
+    async def run_build(self, image, dockerfile, stream):
+        async with self.semaphore:
+            build_stream = self.docker.async_build(
+                fileobj = BytesIO(dockerfile.encode('utf8')),
+                tag     = image,
+                decode  = True,
+                rm      = True
+            )
+            succeeded = await stream(build_stream)
+
+        self.docker.forget_image(image)
+
+        return image if succeeded else None
+
+    async def collect_forever(self):
+        while True:
+            await asyncio.sleep(BuildService.GC_INTERVAL)
+
+            try:
+                await self.collect()
+            except Exception as e:
+                self.debug('Image collection failed: {}'.format(e))
+
+    async def collect(self):
+        referenced = set()
+        for image in self.referenced_images():
+            referenced.add(image)
+            referenced.add('{}:latest'.format(image))
+
+        images = await self.docker.call(self.docker.client.images)
+        tags = [
+            tag for image in images
+            for tag in image.get('RepoTags') or []
+            if tag.startswith(TAG_PREFIX)
+                and tag not in referenced
+                and tag.split(':')[0] not in self.pinned
+        ]
+
+        for tag in tags:
+            self.debug('Removing unreferenced image {}'.format(tag))
+            self.docker.forget_image(tag.split(':')[0])
+            try:
+                await self.docker.call(self.docker.client.remove_image, tag)
+            except Exception as e:
+                # Most likely still used by a container, retried next time
+                self.debug('Could not remove {}: {}'.format(tag, e))
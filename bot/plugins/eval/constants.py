@@ -0,0 +1,2 @@
+POOL_SIZE_KEY = 'pool_size'
+POOL_SIZES_KEY = 'pool_sizes'
@@ -1,83 +1,251 @@
 from globibot.lib.helpers.async_iterator import AsyncIterator
 
 from docker import Client as DockerClient
+from docker.errors import APIError, NotFound
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
 from time import time
 
+import shlex
+import tarfile
 import asyncio
 
 # TODO: sort those constants out
 WORK_DIR = '/snippets'
+SNIPPET_FILE = 'code.snippet'
 TIMEOUT = 10
 PID_LIMIT = 20
+MEMORY_LIMIT = '256m'
+CPU_PERIOD = 100000
+CPU_QUOTA = 50000 # half a CPU
 VOLUME_PREFIX = 'globibot_user-volume_'
 VOLUME_MAX_SIZE = '150m'
 PERSISTENT_DATA_DIR = '/persistent'
 
 volume_name = lambda snowflake: '{}{}'.format(VOLUME_PREFIX, snowflake)
 
-class AsyncDockerClient(DockerClient):
+class Execution(AsyncIterator):
+    '''
+    The output of a run, along with the exit code it ended with
+    The exit code is None when the run timed out or could not be inspected
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.exit_code = asyncio.Future()
+
+class AsyncDockerClient:
+    '''
+    Runs the blocking docker-py calls on a dedicated thread pool so that a
+    slow Docker daemon never blocks the event loop
+    '''
 
     class Timeout(Exception):
         pass
 
+    class CannotIdle(Exception):
+        pass
+
+    WORKERS = 8
+
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs, version='auto')
+        self.client = DockerClient(*args, **kwargs, version='auto')
+        self.executor = ThreadPoolExecutor(max_workers=AsyncDockerClient.WORKERS)
 
+        self.images = dict()
         self.user_volumes = set()
-        for volume in self.volumes()['Volumes']:
+        self.volumes_loaded = asyncio.ensure_future(self.load_user_volumes())
+
+    async def call(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            partial(method, *args, **kwargs)
+        )
+
+    async def load_user_volumes(self):
+        volumes = await self.call(self.client.volumes)
+
+        for volume in volumes['Volumes']:
             if volume['Name'].startswith(VOLUME_PREFIX):
                 user_id = volume['Name'][len(VOLUME_PREFIX):]
                 self.user_volumes.add(user_id)
 
     def async_build(self, *args, **kwargs):
         iterator = AsyncIterator()
-        iterator.start(self.build, *args, **kwargs)
+        iterator.start(self.client.build, *args, **kwargs)
 
         return iterator
 
-    def run_async(self, command, directory, image, user_id):
+    # Keeps pre-warmed containers alive until a snippet is exec'd into them
+    IDLE_ENTRYPOINT = ['tail', '-f', '/dev/null']
+
+    async def create_container(self, image, user_id, **kwargs):
+        await self.volumes_loaded
         if user_id not in self.user_volumes:
-            self.create_volume_for(user_id)
+            await self.create_volume_for(user_id)
 
         volume = volume_name(user_id)
-        host_config = self.create_host_config(binds = {
-            directory: dict(bind=WORK_DIR),
-            volume: dict(bind=PERSISTENT_DATA_DIR)
-        })
+        host_config = self.client.create_host_config(
+            binds = {
+                volume: dict(bind=PERSISTENT_DATA_DIR)
+            },
+            mem_limit     = MEMORY_LIMIT,
+            memswap_limit = MEMORY_LIMIT,
+            cpu_period    = CPU_PERIOD,
+            cpu_quota     = CPU_QUOTA
+        )
         host_config['PidsLimit'] = PID_LIMIT
 
-        container = self.create_container(
-            volumes     = [WORK_DIR, PERSISTENT_DATA_DIR],
+        return await self.call(
+            self.client.create_container,
+            volumes     = [PERSISTENT_DATA_DIR],
             image       = image,
             working_dir = WORK_DIR,
             host_config = host_config,
-            command     = command
+            **kwargs
         )
-        self.start(container)
 
-        iterator = AsyncIterator()
-        executor = iterator.start(self.logs, container, stream=True)
-        asyncio.ensure_future(self.poll_container(container, executor))
+    async def create_idle_container(self, image, user_id):
+        container = await self.create_container(
+            image, user_id,
+            entrypoint = AsyncDockerClient.IDLE_ENTRYPOINT
+        )
+
+        try:
+            await self.call(self.client.start, container)
+        except APIError as e:
+            # Most likely an image without tail
+            await self.remove(container)
+            raise AsyncDockerClient.CannotIdle(e)
+
+        return container
+
+    async def image_command(self, image, command):
+        '''
+        What the image would have run for this command, had the container not
+        been started idle
+        '''
+        config = (await self.inspect_image(image))['Config']
+
+        entrypoint = config.get('Entrypoint') or []
+        args = shlex.split(command) or config.get('Cmd') or []
+
+        return entrypoint + args
+
+    async def put_snippet(self, container, code):
+        '''
+        Ships the code straight into the container's work directory, without
+        going through the host's disk
+        '''
+        data = code.encode('utf8')
+        info = tarfile.TarInfo(SNIPPET_FILE)
+        info.size = len(data)
+        info.mtime = time()
+
+        archive = BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            tar.addfile(info, BytesIO(data))
+
+        await self.call(
+            self.client.put_archive,
+            container, WORK_DIR, archive.getvalue()
+        )
+
+    async def exec_async(self, container, image, command):
+        cmd = await self.image_command(image, command)
+        execution = await self.call(self.client.exec_create, container, cmd)
+
+        iterator = Execution()
+        iterator.start(self.client.exec_start, execution, stream=True)
+        exit_code = partial(self.exec_exit_code, execution)
+        asyncio.ensure_future(self.wait_execution(container, iterator, exit_code))
+
+        return iterator
+
+    async def run_async(self, command, code, image, user_id):
+        container = await self.create_idle_container(image, user_id)
+        await self.put_snippet(container, code)
+
+        return await self.exec_async(container, image, command)
+
+    async def run_once(self, command, code, image, user_id):
+        '''
+        Runs the image's own entrypoint in a fresh container, for images that
+        cannot be kept idle
+        '''
+        container = await self.create_container(
+            image, user_id,
+            command = shlex.split(command) or None
+        )
+        await self.put_snippet(container, code)
+        await self.call(self.client.start, container)
+
+        # The logs are replayed from the start, nothing is missed by attaching
+        # after the container started
+        iterator = Execution()
+        iterator.start(
+            self.client.attach, container,
+            stream=True, logs=True
+        )
+        exit_code = partial(self.call, self.client.wait, container)
+        asyncio.ensure_future(self.wait_execution(container, iterator, exit_code))
 
         return iterator
 
-    async def poll_container(self, container, executor):
-        started = time()
+    async def exec_exit_code(self, execution):
+        return (await self.call(self.client.exec_inspect, execution))['ExitCode']
+
+    async def wait_execution(self, container, execution, exit_code):
+        try:
+            await asyncio.wait_for(asyncio.shield(execution.finished), TIMEOUT)
+        except asyncio.TimeoutError:
+            execution.throw(AsyncDockerClient.Timeout)
+            execution.cancel()
+            try:
+                await self.call(self.client.kill, container)
+            except APIError:
+                # It exited on its own right at the timeout
+                pass
+        else:
+            try:
+                execution.exit_code.set_result(await exit_code())
+            except APIError:
+                pass
+        finally:
+            if not execution.exit_code.done():
+                execution.exit_code.set_result(None)
+            await self.remove(container)
+
+    async def remove(self, container):
+        await self.call(self.client.remove_container, container, force=True)
+
+    async def inspect_image(self, image):
+        try:
+            return self.images[image]
+        except KeyError:
+            info = await self.call(self.client.inspect_image, image)
+            self.images[image] = info
+            return info
+
+    async def has_image(self, image):
+        try:
+            await self.inspect_image(image)
+        except NotFound:
+            return False
+        else:
+            return True
 
-        while True:
-            await asyncio.sleep(1)
-            state = self.inspect_container(container)
-            if not state['State']['Running']:
-                break
-            if time() - started > TIMEOUT:
-                executor.throw(AsyncDockerClient.Timeout)
-                self.kill(container)
-                break
+    async def image_id(self, image):
+        return (await self.inspect_image(image))['Id']
 
-        self.remove_container(container, force=True)
+    def forget_image(self, image):
+        self.images.pop(image, None)
 
-    def create_volume_for(self, user_id):
-        self.create_volume(
+    async def create_volume_for(self, user_id):
+        await self.call(
+            self.client.create_volume,
             name        = volume_name(user_id),
             driver      = 'local',
             # driver_opts = dict(
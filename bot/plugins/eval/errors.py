@@ -0,0 +1,13 @@
+from globibot.lib.errors import PluginException
+
+class QueueFull(PluginException):
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def error(self, message):
+        return (
+            '{} You already have `{}` evaluations waiting, '
+            'wait for them to finish'
+                .format(message.author.mention, self.limit)
+        )
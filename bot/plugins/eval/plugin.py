@@ -3,19 +3,24 @@ from globibot.lib.decorators import command
 from globibot.lib.helpers import parsing as p
 from globibot.lib.helpers import formatting as f
 from globibot.lib.helpers.hooks import master_only
+from globibot.lib.helpers.cache import LRUCache
 
-from io import BytesIO
-from shutil import rmtree
-from collections import namedtuple
+from collections import namedtuple, deque
 
 from .docker import AsyncDockerClient
+from .pool import ContainerPool
+from .scheduler import JobScheduler
+from .results import ResultCache
+from .builds import BuildService
 from . import queries as q
+from . import constants as c
+from . import errors as e
 
-import os
+import asyncio
 
 Environment = namedtuple(
     'Environment',
-    ['id', 'author_id', 'name', 'language', 'image', 'dockerfile']
+    ['id', 'author_id', 'name', 'language', 'image', 'dockerfile', 'deterministic']
 )
 
 Snippet = namedtuple(
@@ -25,16 +30,54 @@ Snippet = namedtuple(
 
 class Eval(Plugin):
 
+    DEFAULT_POOL_SIZE = 4
+
+    MAX_CONCURRENT_JOBS = 4
+    MAX_CONCURRENT_JOBS_PER_USER = 1
+    MAX_CONCURRENT_JOBS_PER_GUILD = 2
+    MAX_QUEUED_JOBS_PER_USER = 3
+
+    RESULT_CACHE_SIZE = 256
+    RESULT_CACHE_TTL = 60 * 60
+
+    OUTPUT_LINES = 15
+
+    USER_CACHE_SIZE = 1024
+
     def load(self):
         self.docker = AsyncDockerClient()
+        self.pool = ContainerPool(self.docker, self.debug)
+        self.pool_size = self.config.get(c.POOL_SIZE_KEY, Eval.DEFAULT_POOL_SIZE)
+        # Keyed by environment name, images are named after their Dockerfile
+        self.pool_sizes = self.config.get(c.POOL_SIZES_KEY, dict())
+        self.run_async(self.pool.sweep_forever())
+
+        self.scheduler = JobScheduler(
+            Eval.MAX_CONCURRENT_JOBS,
+            Eval.MAX_CONCURRENT_JOBS_PER_USER,
+            Eval.MAX_CONCURRENT_JOBS_PER_GUILD,
+            Eval.MAX_QUEUED_JOBS_PER_USER
+        )
 
         with self.transaction() as trans:
             trans.execute(q.fetch_behaviors)
             self.behaviors = [row[0] for row in trans.fetchall()]
             self.default_behavior = self.behaviors[0]
 
+        self.builds = BuildService(self.docker, self.referenced_images, self.debug)
+        self.run_async(self.builds.collect_forever())
+
+        self.results = ResultCache(Eval.RESULT_CACHE_SIZE, Eval.RESULT_CACHE_TTL)
+
+        self.user_behaviors = LRUCache(Eval.USER_CACHE_SIZE)
+        self.user_environments = LRUCache(Eval.USER_CACHE_SIZE)
+        self.user_snippets = LRUCache(Eval.USER_CACHE_SIZE)
+
         self.last_snippets = dict()
 
+    def unload(self):
+        asyncio.ensure_future(self.pool.shutdown())
+
     '''
     Commands
     '''
@@ -77,16 +120,14 @@ class Eval(Plugin):
     async def eval_save(self, message, name):
         try:
             snippet = self.last_snippets[message.author.id]
-            snippets = self.get_snippets(message.author.id)
-            try:
-                next(s for s in snippets if s.name == name)
+            if self.get_snippet(message.author.id, name):
                 await self.send_message(
                     message.channel,
                     '{} You already have a snippet named `{}`'
                         .format(message.author.mention, name),
                     delete_after = 30
                 )
-            except StopIteration:
+            else:
                 if self.save_snippet(message.author.id, name, snippet):
                     await self.send_message(
                         message.channel,
@@ -192,15 +233,61 @@ class Eval(Plugin):
         # Removing old mappings
         for env in environments:
             if env.language == language:
-                self.set_environment_language(env.id, 'none')
+                self.set_environment_language(env, 'none')
         # Flagging the env with the language
-        self.set_environment_language(env.id, language)
+        self.set_environment_language(env, language)
         await self.send_message(
             message.channel,
             '{} Your `{}` snippets will now be evaluated with your `{}` environment'
                 .format(message.author.mention, language, env_name)
         )
 
+    @command(eval_env_prefix + p.string('deterministic')
+                             + p.bind(p.word, 'env_name')
+                             + p.bind(p.word, 'state'))
+    async def eval_env_deterministic(self, message, env_name, state):
+        if state not in ('on', 'off'):
+            return
+
+        environments = self.get_environments(message.author.id)
+
+        try:
+            env = next(e for e in environments if e.name == env_name and e.author_id)
+        except StopIteration:
+            await self.send_message(
+                message.channel,
+                '{} You don\'t have any environment saved under the name `{}`'
+                    .format(message.author.mention, env_name),
+                delete_after=10
+            )
+            return
+
+        self.set_environment_deterministic(env, state == 'on')
+        await self.send_message(
+            message.channel,
+            '{} Outputs of your `{}` environment will {}be cached'
+                .format(
+                    message.author.mention,
+                    env_name,
+                    '' if state == 'on' else 'no longer '
+                ),
+            delete_after=10
+        )
+
+    @command(eval_prefix + p.string('stats'), master_only)
+    async def eval_stats(self, message):
+        stats = [
+            ('Cached results', len(self.results)),
+            ('Cache hits', self.results.hits),
+            ('Cache misses', self.results.misses),
+        ]
+
+        await self.send_message(
+            message.channel,
+            f.code_block(f.pad_rows(stats, ' | ')),
+            delete_after=30
+        )
+
     @command(
         eval_env_prefix + p.string('library') + p.string('build')
                         + p.bind(p.word,    'env_name')
@@ -209,34 +296,10 @@ class Eval(Plugin):
         master_only
     )
     async def build_env_library(self, message, env_name, language, snippet):
-        if snippet.language != 'dockerfile':
-            return
-
-        response_stream = await self.send_message(message.channel, 'Building...')
-        dockerfile = BytesIO(snippet.code.encode('utf8'))
-        flags = dict(errored=False)
-
-        image = self.tag_name(env_name)
-        build_stream = self.docker.async_build(
-            fileobj=dockerfile,
-            tag=image,
-            decode=True,
-            rm=True
+        await self.build_environment(
+            message, None, 'library/{}'.format(env_name), language, snippet
         )
 
-        def format_data(data):
-            flags['errored'] = ('error' in data)
-            return '\n'.join([str(v) for v in data.values()])
-
-        errored = flags['errored']
-        if not errored:
-            self.save_environment(None, 'library/{}'.format(env_name), image, snippet.code, language)
-
-        await self.stream_data(response_stream, build_stream, format_data)
-        notice = 'Build errored' if errored else 'Build succeeded'
-        await self.send_message(message.channel, notice)
-        await self.delete_message_after(response_stream, 10)
-
     @command(
         eval_env_prefix + p.string('build')
                         + p.bind(p.word,    'env_name')
@@ -244,34 +307,10 @@ class Eval(Plugin):
                         + p.bind(p.snippet, 'snippet')
     )
     async def build_env(self, message, env_name, language, snippet):
-        if snippet.language != 'dockerfile':
-            return
-
-        response_stream = await self.send_message(message.channel, 'Building...')
-        dockerfile = BytesIO(snippet.code.encode('utf8'))
-        flags = dict(errored=False)
-
-        image = self.tag_name(env_name, message.author.id)
-        build_stream = self.docker.async_build(
-            fileobj=dockerfile,
-            tag=image,
-            decode=True,
-            rm=True
+        await self.build_environment(
+            message, message.author.id, env_name, language, snippet
         )
 
-        def format_data(data):
-            flags['errored'] = ('error' in data)
-            return '\n'.join([str(v) for v in data.values()])
-
-        errored = flags['errored']
-        if not errored:
-            self.save_environment(message.author.id, env_name, image, snippet.code, language)
-
-        await self.stream_data(response_stream, build_stream, format_data)
-        notice = 'Build errored' if errored else 'Build succeeded'
-        await self.send_message(message.channel, notice)
-        await self.delete_message_after(response_stream, 10)
-
     @command(
         p.string('!eval') + p.string('behavior')
                           + p.eof
@@ -309,6 +348,32 @@ class Eval(Plugin):
     details
     '''
 
+    async def schedule(self, message, response, job):
+        flags = dict(queued=False)
+
+        async def on_position(position):
+            flags['queued'] = True
+            await self.edit_message(
+                response,
+                '`Queued: position {}`'.format(position)
+            )
+
+        async def run():
+            if flags['queued']:
+                await self.edit_message(response, response.content)
+            return await job()
+
+        guild_id = message.server.id if message.server else None
+
+        try:
+            return await self.scheduler.run(
+                message.author.id, guild_id,
+                run, on_position
+            )
+        except e.QueueFull:
+            await self.bot.delete_message(response)
+            raise
+
     async def run_snippet(self, message, snippet, args):
         environment = self.get_environment(snippet.language, message.author.id)
         if environment is None:
@@ -319,41 +384,95 @@ class Eval(Plugin):
                 delete_after=10
             )
         else:
-            directory = '/tmp/globibot/{}'.format(message.author.id)
-            os.makedirs(directory, exist_ok=True)
-            with open('{}/{}'.format(directory, 'code.snippet'), 'w') as f:
-                f.write(snippet.code)
-
             response_stream = await self.send_message(
                 message.channel,
                 '`Waiting for output`'
             )
 
-            run_stream = self.docker.run_async(
-                args,
-                directory,
-                environment.image,
-                message.author.id
-            )
-            format_data = lambda line: line.decode('utf8')
+            result_key = None
+            if environment.deterministic:
+                image_id = await self.docker.image_id(environment.image)
+                result_key = ResultCache.key(
+                    image_id, message.author.id, snippet.code, args
+                )
+
+                output = self.results.get(result_key)
+                if output is not None:
+                    await self.edit_message(response_stream, f.code_block(output))
+                    await self.send_message(message.channel, '`Exited (cached)`', delete_after=10)
+                    return
+
+            output = deque(maxlen=Eval.OUTPUT_LINES)
+            def format_data(line):
+                text = line.decode('utf8')
+                output.append(text)
+                return text
+
+            async def evaluate():
+                run_stream = await self.pool.run(
+                    args,
+                    snippet.code,
+                    environment.image,
+                    message.author.id,
+                    self.pool_sizes.get(environment.name, self.pool_size)
+                )
+
+                try:
+                    await self.stream_data(
+                        response_stream, run_stream, format_data,
+                        lines=Eval.OUTPUT_LINES
+                    )
+                    await self.send_message(message.channel, '`Exited`', delete_after=10)
+                    # Killed or crashed runs say nothing about the code
+                    if result_key and await run_stream.exit_code == 0:
+                        self.results.put(result_key, list(output))
+                except AsyncDockerClient.Timeout:
+                    await self.send_message(message.channel, '`Evaluation timed out`')
+
+            await self.schedule(message, response_stream, evaluate)
+
+    async def build_environment(self, message, author_id, env_name, language, snippet):
+        if snippet.language != 'dockerfile':
+            return
+
+        response_stream = await self.send_message(message.channel, 'Building...')
+
+        async def stream_build(build_stream):
+            flags = dict(errored=False)
 
+            def format_data(data):
+                if 'error' in data:
+                    flags['errored'] = True
+                return '\n'.join([str(v) for v in data.values()])
+
+            await self.stream_data(response_stream, build_stream, format_data)
+            return not flags['errored']
+
+        build = lambda: self.builds.build(snippet.code, stream_build)
+        image = await self.schedule(message, response_stream, build)
+
+        if image:
             try:
-                await self.stream_data(response_stream, run_stream, format_data)
-                await self.send_message(message.channel, '`Exited`', delete_after=10)
-            except AsyncDockerClient.Timeout:
-                await self.send_message(message.channel, '`Evaluation timed out`')
+                self.save_environment(author_id, env_name, image, snippet.code, language)
+            finally:
+                self.builds.release(image)
+
+        notice = 'Build succeeded' if image else 'Build errored'
+        await self.send_message(message.channel, notice)
+        await self.delete_message_after(response_stream, 10)
 
-            rmtree(directory)
+    def referenced_images(self):
+        with self.transaction() as trans:
+            trans.execute(q.get_images)
 
-    TAG_PREFIX = 'globibot_build'
-    def tag_name(self, name, user_id=None):
-        return '{}_{}:{}'.format(
-            Eval.TAG_PREFIX,
-            name,
-            user_id if user_id else 'library'
-        ),
+            return [image for image, in trans.fetchall()]
 
     def get_behavior(self, user_id):
+        try:
+            return self.user_behaviors[user_id]
+        except KeyError:
+            pass
+
         with self.transaction() as trans:
             trans.execute(q.get_behavior, dict(
                 author_id = user_id
@@ -361,12 +480,15 @@ class Eval(Plugin):
 
             row = trans.fetchone()
             if row:
+                self.user_behaviors[user_id] = row[0]
                 return row[0]
             else:
                 trans.execute(q.set_default_behavior, dict(
                     author_id = user_id,
                 ))
 
+        self.user_behaviors[user_id] = self.default_behavior
+
     def set_user_behavior(self, user_id, behavior):
         with self.transaction() as trans:
             trans.execute(q.set_behavior, dict(
@@ -374,24 +496,41 @@ class Eval(Plugin):
                 behavior  = behavior
             ))
 
+        self.user_behaviors[user_id] = behavior
+
     def get_environment(self, language, user_id):
-        with self.transaction() as trans:
-            trans.execute(q.get_environment, dict(
-                author_id = user_id,
-                language  = language
-            ))
+        environments = [
+            env for env in self.get_environments(user_id)
+            if env.language == language
+        ]
 
-            row = trans.fetchone()
-            if row:
-                return Environment(*row)
+        # The user's own environments take precedence over the library
+        environments.sort(key=lambda env: env.author_id is None)
+
+        return environments[0] if environments else None
 
     def get_environments(self, user_id):
+        try:
+            return self.user_environments[user_id]
+        except KeyError:
+            pass
+
         with self.transaction() as trans:
             trans.execute(q.get_environments, dict(
                 author_id = user_id,
             ))
 
-            return [Environment(*row) for row in trans.fetchall()]
+            environments = [Environment(*row) for row in trans.fetchall()]
+
+        self.user_environments[user_id] = environments
+        return environments
+
+    def invalidate_environments(self, author_id):
+        # Library environments are listed for everyone
+        if author_id is None:
+            self.user_environments.clear()
+        else:
+            self.user_environments.invalidate(str(author_id))
 
     def save_environment(self, user_id, env_name, image, dockerfile, language):
         with self.transaction() as trans:
@@ -403,33 +542,54 @@ class Eval(Plugin):
                 language   = language
             ))
 
-    def set_environment_language(self, env_id, language):
+        self.invalidate_environments(user_id)
+
+    def set_environment_deterministic(self, env, deterministic):
         with self.transaction() as trans:
-            trans.execute(q.set_language, dict(
-                id       = env_id,
-                language = language
+            trans.execute(q.set_deterministic, dict(
+                id            = env.id,
+                deterministic = deterministic
             ))
 
-    def get_snippet(self, user_id, name):
+        self.invalidate_environments(env.author_id)
+
+    def set_environment_language(self, env, language):
         with self.transaction() as trans:
-            trans.execute(q.get_snippet, dict(
-                author_id = user_id,
-                name      = name
+            trans.execute(q.set_language, dict(
+                id       = env.id,
+                language = language
             ))
 
-            data = trans.fetchone()
-            if data:
-                return Snippet(*data)
+        self.invalidate_environments(env.author_id)
+
+    def get_snippet(self, user_id, name):
+        return self.user_snippets_by_name(user_id).get(name)
 
     def get_snippets(self, user_id):
+        return list(self.user_snippets_by_name(user_id).values())
+
+    def user_snippets_by_name(self, user_id):
+        try:
+            return self.user_snippets[user_id]
+        except KeyError:
+            pass
+
         with self.transaction() as trans:
             trans.execute(q.get_snippets, dict(
                 author_id = user_id
             ))
 
-            return [Snippet(*row) for row in trans.fetchall()]
+            snippets = dict(
+                (snippet.name, snippet)
+                for snippet in (Snippet(*row) for row in trans.fetchall())
+            )
+
+        self.user_snippets[user_id] = snippets
+        return snippets
 
     def save_snippet(self, user_id, name, snippet):
+        snippets = self.user_snippets_by_name(user_id)
+
         with self.transaction() as trans:
             trans.execute(q.save_snippet, dict(
                 author_id = user_id,
@@ -438,4 +598,8 @@ class Eval(Plugin):
                 code      = snippet.code
             ))
 
-            return True
+            snippet_id, = trans.fetchone()
+
+        snippets[name] = Snippet(snippet_id, user_id, name, snippet.language, snippet.code)
+
+        return True
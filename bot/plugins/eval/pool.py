@@ -0,0 +1,123 @@
+from globibot.lib.helpers.cache import LRUCache
+
+from .docker import AsyncDockerClient
+
+from collections import OrderedDict, defaultdict
+from time import time
+
+import asyncio
+
+class ContainerPool:
+    '''
+    Keeps started, idle containers around so that running a snippet only
+    costs an exec instead of a full container creation
+    Containers are bound to a user's volume, so they are pooled per image and
+    per user. They are never reused: a fresh one is warmed up in the
+    background after every run, which also resets the filesystem
+    Images that cannot be kept idle are run the usual way instead, until
+    pooling them is tried again
+    '''
+
+    IDLE_TIMEOUT = 60 * 30
+    SWEEP_INTERVAL = 60
+    UNPOOLABLE_SIZE = 256
+    UNPOOLABLE_RETRY = 60 * 30
+
+    def __init__(self, docker, debug):
+        self.docker = docker
+        self.debug = debug
+
+        # Set by the environments running the image, see run
+        self.sizes = dict()
+
+        self.containers = defaultdict(OrderedDict)
+        self.last_used = dict()
+        self.unpoolable = LRUCache(
+            ContainerPool.UNPOOLABLE_SIZE,
+            ttl=ContainerPool.UNPOOLABLE_RETRY
+        )
+
+    def size_of(self, image):
+        return self.sizes.get(image, 0)
+
+    async def run(self, command, code, image, user_id, size):
+        self.sizes[image] = size
+
+        if image in self.unpoolable:
+            return await self.docker.run_once(command, code, image, user_id)
+
+        self.last_used[image] = time()
+
+        container = self.containers[image].pop(user_id, None)
+        if container is None:
+            try:
+                container = await self.docker.create_idle_container(image, user_id)
+            except AsyncDockerClient.CannotIdle as e:
+                self.mark_unpoolable(image, e)
+                return await self.docker.run_once(command, code, image, user_id)
+
+        asyncio.ensure_future(self.warm_up(image, user_id))
+
+        # Once exec'd, the container is removed along with the execution
+        try:
+            await self.docker.put_snippet(container, code)
+            return await self.docker.exec_async(container, image, command)
+        except:
+            await self.docker.remove(container)
+            raise
+
+    def mark_unpoolable(self, image, error):
+        self.debug('Cannot keep {} idle, running it directly: {}'.format(image, error))
+        self.unpoolable[image] = True
+        asyncio.ensure_future(self.invalidate(image))
+
+    async def warm_up(self, image, user_id):
+        size = self.size_of(image)
+        if not size or image in self.unpoolable:
+            return
+
+        try:
+            container = await self.docker.create_idle_container(image, user_id)
+        except AsyncDockerClient.CannotIdle as e:
+            self.mark_unpoolable(image, e)
+            return
+        except Exception as e:
+            self.debug('Could not warm up {}: {}'.format(image, e))
+            return
+
+        containers = self.containers[image]
+        previous = containers.pop(user_id, None)
+        containers[user_id] = container
+
+        evicted = [previous] if previous else []
+        while len(containers) > size:
+            _, container = containers.popitem(last=False)
+            evicted.append(container)
+
+        for container in evicted:
+            await self.docker.remove(container)
+
+    async def invalidate(self, image):
+        self.docker.forget_image(image)
+        containers = self.containers.pop(image, dict())
+
+        for container in containers.values():
+            await self.docker.remove(container)
+
+    async def sweep_forever(self):
+        while True:
+            await asyncio.sleep(ContainerPool.SWEEP_INTERVAL)
+
+            now = time()
+            idle_images = [
+                image for image in self.containers
+                if now - self.last_used.get(image, 0) > ContainerPool.IDLE_TIMEOUT
+            ]
+
+            for image in idle_images:
+                self.debug('Evicting idle containers of {}'.format(image))
+                await self.invalidate(image)
+
+    async def shutdown(self):
+        for image in list(self.containers):
+            await self.invalidate(image)
@@ -20,15 +20,8 @@ set_default_behavior = '''
 
 '''
 
-get_environment = '''
-    select      id, author_id, name, language, image, dockerfile
-        from    eval_environment
-        where   (author_id = (%(author_id)s) or author_id is null)
-            and language = (%(language)s)
-'''
-
 get_environments = '''
-    select      id, author_id, name, language, image, dockerfile
+    select      id, author_id, name, language, image, dockerfile, deterministic
         from    eval_environment
         where   (author_id = (%(author_id)s) or author_id is null)
 '''
@@ -37,22 +30,27 @@ save_environment = '''
     insert into eval_environment (author_id, name, language, image, dockerfile)
     values                       (%(author_id)s, %(name)s, %(language)s, %(image)s, %(dockerfile)s)
     on conflict                  (author_id, name)
-    do update set   dockerfile = %(dockerfile)s
+    do update set   dockerfile = %(dockerfile)s,
+                    image      = %(image)s
               where     eval_environment.author_id  = %(author_id)s
                     and eval_environment.name = %(name)s
 '''
 
-set_language = '''
+get_images = '''
+    select distinct image
+    from   eval_environment
+'''
+
+set_deterministic = '''
     update eval_environment
-    set    language = %(language)s
+    set    deterministic = %(deterministic)s
     where  id = %(id)s
 '''
 
-get_snippet = '''
-    select id, author_id, name, language, code
-    from   eval_snippet
-    where  author_id = %(author_id)s
-    and    name = %(name)s
+set_language = '''
+    update eval_environment
+    set    language = %(language)s
+    where  id = %(id)s
 '''
 
 get_snippets = '''
@@ -64,4 +62,5 @@ get_snippets = '''
 save_snippet = '''
     insert into eval_snippet (author_id, name, language, code)
     values                   (%(author_id)s, %(name)s, %(language)s, %(code)s)
+    returning id
 '''
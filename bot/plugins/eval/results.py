@@ -0,0 +1,41 @@
+from globibot.lib.helpers.cache import LRUCache
+
+from hashlib import sha256
+
+class ResultCache:
+    '''
+    Output of runs in deterministic environments, addressed by the image, the
+    user, the code and the arguments that produced it
+    The user is part of the key because runs can read their own persistent
+    volume, whose content must never be served to anyone else
+    '''
+
+    def __init__(self, max_size, ttl):
+        self.results = LRUCache(max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image_id, user_id, code, args):
+        digest = sha256()
+        for part in (image_id, user_id, code, args):
+            digest.update(part.encode('utf8'))
+            digest.update(b'\0')
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        try:
+            output = self.results[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        else:
+            self.hits += 1
+            return output
+
+    def put(self, key, output):
+        self.results[key] = output
+
+    def __len__(self):
+        return len(self.results)
@@ -0,0 +1,108 @@
+from collections import OrderedDict, Counter, deque
+from itertools import zip_longest
+
+from . import errors as e
+
+import asyncio
+
+class Job:
+
+    def __init__(self, user_id, guild_id, on_position):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.on_position = on_position
+
+        self.started = asyncio.Future()
+        self.position = None
+
+class JobScheduler:
+    '''
+    Runs eval jobs under a global concurrency cap and per user / per guild
+    quotas
+    Waiting jobs are served round-robin across users so that a single user
+    queueing many jobs cannot starve the others
+    '''
+
+    def __init__(self, concurrency, user_quota, guild_quota, user_queue_limit):
+        self.concurrency = concurrency
+        self.user_quota = user_quota
+        self.guild_quota = guild_quota
+        self.user_queue_limit = user_queue_limit
+
+        self.pending = OrderedDict()
+        self.running = 0
+        self.running_by_user = Counter()
+        self.running_by_guild = Counter()
+
+    async def run(self, user_id, guild_id, job_function, on_position=None):
+        queue = self.pending.setdefault(user_id, deque())
+        if len(queue) >= self.user_queue_limit:
+            raise e.QueueFull(self.user_queue_limit)
+
+        job = Job(user_id, guild_id, on_position)
+        queue.append(job)
+        self.dispatch()
+
+        try:
+            await job.started
+        except asyncio.CancelledError:
+            if job.started.done() and not job.started.cancelled():
+                self.release(job)
+            else:
+                self.discard(job)
+            self.dispatch()
+            raise
+
+        try:
+            return await job_function()
+        finally:
+            self.release(job)
+            self.dispatch()
+
+    def waiting_order(self):
+        rounds = zip_longest(*self.pending.values())
+        return [job for jobs in rounds for job in jobs if job]
+
+    def can_start(self, job):
+        if self.running_by_user[job.user_id] >= self.user_quota:
+            return False
+        if job.guild_id and self.running_by_guild[job.guild_id] >= self.guild_quota:
+            return False
+        return True
+
+    def dispatch(self):
+        for job in self.waiting_order():
+            if self.running >= self.concurrency:
+                break
+
+            # Cancelled while waiting, about to be discarded by its runner
+            if job.started.cancelled():
+                continue
+
+            if self.can_start(job):
+                self.discard(job)
+                # Served users go to the back of the line
+                if job.user_id in self.pending:
+                    self.pending.move_to_end(job.user_id)
+
+                self.running += 1
+                self.running_by_user[job.user_id] += 1
+                self.running_by_guild[job.guild_id] += 1
+                job.started.set_result(None)
+
+        for position, job in enumerate(self.waiting_order(), 1):
+            if job.position != position:
+                job.position = position
+                if job.on_position:
+                    asyncio.ensure_future(job.on_position(position))
+
+    def discard(self, job):
+        queue = self.pending[job.user_id]
+        queue.remove(job)
+        if not queue:
+            del self.pending[job.user_id]
+
+    def release(self, job):
+        self.running -= 1
+        self.running_by_user[job.user_id] -= 1
+        self.running_by_guild[job.guild_id] -= 1
@@ -0,0 +1,167 @@
+from PIL import Image
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from .errors import ImageTooLarge
+
+import asyncio
+
+MAX_INPUT_BYTES = 8 * 1024 * 1024
+MAX_INPUT_PIXELS = 4096 * 4096
+
+class Layer:
+    '''
+    Pastes the `source` image at `position`, resized to `size` if any
+    Negative coordinates are relative to the right and bottom edges
+    '''
+
+    def __init__(self, source, position=(0, 0), size=None):
+        self.source = source
+        self.position = position
+        self.size = size
+
+    def box(self, canvas):
+        x, y = self.position
+
+        if x < 0:
+            x += canvas.width
+        if y < 0:
+            y += canvas.height
+
+        return (x, y)
+
+class Template:
+    '''
+    Stacks `layers` over the `background` image, or over a blank canvas of
+    `size` when there is none
+    Sources that are URLs are static images fetched once, the others must
+    be given when rendering
+    '''
+
+    def __init__(self, layers, background=None, size=None, mode='RGB'):
+        self.layers = layers
+        self.background = background
+        self.size = size
+        self.mode = mode
+
+    @property
+    def sources(self):
+        sources = set(layer.source for layer in self.layers)
+        if self.background is not None:
+            sources.add(self.background)
+
+        return sources
+
+    @property
+    def statics(self):
+        return set(
+            source for source in self.sources
+            if source.startswith(('http://', 'https://'))
+        )
+
+'''
+Worker side
+'''
+
+# Static images are decoded once per worker process
+decoded_statics = dict()
+
+def open_image(data):
+    image = Image.open(BytesIO(data))
+    image.load()
+
+    return image
+
+def open_static(url, data):
+    try:
+        image = decoded_statics[url]
+    except KeyError:
+        image = open_image(data)
+        decoded_statics[url] = image
+
+    return image
+
+def compose(template, inputs, statics):
+    # Pillow's own decompression bomb check, set here so that it only
+    # applies to the worker process
+    Image.MAX_IMAGE_PIXELS = MAX_INPUT_PIXELS
+
+    images = dict(
+        (url, open_static(url, data)) for url, data in statics.items()
+    )
+    images.update(
+        (name, open_image(data)) for name, data in inputs.items()
+    )
+
+    if template.background is None:
+        canvas = Image.new(template.mode, template.size)
+    else:
+        canvas = images[template.background].copy()
+
+    for layer in template.layers:
+        image = images[layer.source]
+        if layer.size is not None:
+            image = image.resize(layer.size)
+
+        canvas.paste(image, layer.box(canvas))
+
+    buffer = BytesIO()
+    canvas.save(buffer, 'png')
+
+    return buffer.getvalue()
+
+'''
+Event loop side
+'''
+
+def check_input(data):
+    if len(data) > MAX_INPUT_BYTES:
+        raise ImageTooLarge('{} MiB'.format(MAX_INPUT_BYTES // (1024 * 1024)))
+
+    # Only reads the header, the pixels are decoded by the workers
+    image = Image.open(BytesIO(data))
+    if image.width * image.height > MAX_INPUT_PIXELS:
+        raise ImageTooLarge('{} pixels'.format(MAX_INPUT_PIXELS))
+
+class Pipeline:
+    '''
+    Renders templates in worker processes so that image processing never
+    blocks the event loop
+    '''
+
+    WORKERS = 2
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+
+        self.executor = ProcessPoolExecutor(Pipeline.WORKERS)
+        self.statics = dict()
+
+    async def static(self, url):
+        try:
+            data = self.statics[url]
+        except KeyError:
+            data = await self.fetch(url)
+            self.statics[url] = data
+
+        return data
+
+    async def render(self, template, **inputs):
+        for data in inputs.values():
+            check_input(data)
+
+        statics = dict()
+        for url in template.statics:
+            statics[url] = await self.static(url)
+
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(
+            self.executor,
+            compose, template, inputs, statics
+        )
+
+        return BytesIO(data)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
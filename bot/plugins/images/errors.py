@@ -0,0 +1,12 @@
+from globibot.lib.errors import PluginException
+
+class ImageTooLarge(PluginException):
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def error(self, message):
+        return (
+            '{} This image is too large (the limit is `{}`)'
+                .format(message.author.mention, self.limit)
+        )
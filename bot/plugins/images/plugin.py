@@ -3,124 +3,132 @@ from globibot.lib.plugin import Plugin
 from globibot.lib.decorators import command
 from globibot.lib.helpers import parsing as p
 from globibot.lib.helpers.hooks import master_only
+from globibot.lib.helpers.cache import LRUCache
 
 from tornado.httpclient import AsyncHTTPClient
 from tornado.platform.asyncio import to_asyncio_future
 
-from PIL import Image
+from .compose import Pipeline, Template, Layer, MAX_INPUT_BYTES
+from .errors import ImageTooLarge
+
+GUN_URL = 'https://dl.dropboxusercontent.com/u/3427186/3071dbc60204c84ca0cf423b8b08a204.png'
+MISTAKE_URL = 'http://i.imgur.com/3nR5fDf.png'
+
+KILL = Template(
+    size   = (512, 256),
+    layers = (
+        Layer('target', position=(0, 0), size=(256, 256)),
+        Layer(GUN_URL, position=(256, 0), size=(256, 256)),
+    )
+)
+
+MISTAKE = Template(
+    background = MISTAKE_URL,
+    layers     = (
+        Layer('target', position=(-505, -557), size=(505, 557)),
+    )
+)
 
 class Images(Plugin):
 
-    # def load(self):
+    AVATAR_CACHE_SIZE = 256
+
+    def load(self):
+        self.client = AsyncHTTPClient()
+        self.pipeline = Pipeline(self.fetch)
+
+        # Avatar URLs change with the avatar
+        self.avatars = LRUCache(Images.AVATAR_CACHE_SIZE)
 
+    def unload(self):
+        self.pipeline.shutdown()
 
-    GUN_URL = 'https://dl.dropboxusercontent.com/u/3427186/3071dbc60204c84ca0cf423b8b08a204.png'
     @command(p.bind(p.mention, 'user_id') + p.string('🔫'), master_only)
     async def kill_user(self, message, user_id):
         member = message.server.get_member(str(user_id))
         if member is None:
             return
 
-        client = AsyncHTTPClient()
-
-        tornado_future = client.fetch(member.avatar_url)
-        future = to_asyncio_future(tornado_future)
-        response = await future
-
-        with open('/tmp/plop.png', 'wb') as f:
-            f.write(response.body)
-
-        tornado_future = client.fetch(Images.GUN_URL)
-        future = to_asyncio_future(tornado_future)
-        response = await future
-
-        with open('/tmp/gun.svg', 'wb') as f:
-            f.write(response.body)
-
-        avatar = Image.open('/tmp/plop.png')
-        gun = Image.open('/tmp/gun.svg')
-        gun.resize(avatar.size)
-
-        total = Image.new('RGB', (avatar.width * 2, avatar.height))
-
-        total.paste(avatar, (0, 0))
-        total.paste(gun, (avatar.width, 0))
-
-        total.save('/tmp/lol.png')
+        image = await self.pipeline.render(
+            KILL,
+            target = await self.avatar(member)
+        )
 
         await self.send_file(
             message.channel,
-            '/tmp/lol.png',
+            image,
+            filename = 'dead.png',
             delete_after = 30,
             content = '{} is now dead 👍'.format(member.mention)
         )
 
-    MISTAKE_URL = 'http://i.imgur.com/3nR5fDf.png'
     @command(p.string('!mistake') + p.bind(p.mention, 'user_id'), master_only)
     async def mistake_user(self, message, user_id):
         member = message.server.get_member(str(user_id))
         if member is None:
             return
 
-        client = AsyncHTTPClient()
-
-        tornado_future = client.fetch(member.avatar_url)
-        future = to_asyncio_future(tornado_future)
-        response = await future
-
-        with open('/tmp/plop.png', 'wb') as f:
-            f.write(response.body)
-
-        tornado_future = client.fetch(Images.MISTAKE_URL)
-        future = to_asyncio_future(tornado_future)
-        response = await future
-
-        with open('/tmp/mistake.png', 'wb') as f:
-            f.write(response.body)
-
-        avatar = Image.open('/tmp/plop.png')
-        mistake = Image.open('/tmp/mistake.png')
-        avatar = avatar.resize((505, 557))
-
-        mistake.paste(avatar, (mistake.width - 505, mistake.height - 557))
-        mistake.save('/tmp/lol.png')
+        image = await self.pipeline.render(
+            MISTAKE,
+            target = await self.avatar(member)
+        )
 
         await self.send_file(
             message.channel,
-            '/tmp/lol.png',
+            image,
+            filename = 'mistake.png',
             delete_after = 30,
         )
 
     @command(p.string('!mistake') + p.bind(p.word, 'url'))
     async def mistake_url(self, message, url):
-        client = AsyncHTTPClient()
-
         try:
-            tornado_future = client.fetch(url)
-            future = to_asyncio_future(tornado_future)
-            response = await future
-
-            with open('/tmp/plop.png', 'wb') as f:
-                f.write(response.body)
+            data = await self.fetch(url)
+        except ImageTooLarge:
+            raise
         except:
             return
 
-        tornado_future = client.fetch(Images.MISTAKE_URL)
-        future = to_asyncio_future(tornado_future)
-        response = await future
-
-        with open('/tmp/mistake.png', 'wb') as f:
-            f.write(response.body)
-
-        img = Image.open('/tmp/plop.png')
-        mistake = Image.open('/tmp/mistake.png')
-        img = img.resize((505, 557))
-
-        mistake.paste(img, (mistake.width - 505, mistake.height - 557))
-        mistake.save('/tmp/lol.png')
+        image = await self.pipeline.render(MISTAKE, target=data)
 
         await self.send_file(
             message.channel,
-            '/tmp/lol.png',
+            image,
+            filename = 'mistake.png',
             delete_after = 30,
         )
+
+    '''
+    Helpers
+    '''
+
+    async def fetch(self, url):
+        chunks = []
+        size = 0
+
+        # Gives up as soon as the body goes over the limit
+        def on_chunk(chunk):
+            nonlocal size
+            size += len(chunk)
+            if size > MAX_INPUT_BYTES:
+                raise ImageTooLarge(
+                    '{} MiB'.format(MAX_INPUT_BYTES // (1024 * 1024))
+                )
+            chunks.append(chunk)
+
+        tornado_future = self.client.fetch(url, streaming_callback=on_chunk)
+        future = to_asyncio_future(tornado_future)
+        await future
+
+        return b''.join(chunks)
+
+    async def avatar(self, member):
+        url = member.avatar_url
+
+        try:
+            data = self.avatars[url]
+        except KeyError:
+            data = await self.fetch(url)
+            self.avatars[url] = data
+
+        return data
@@ -1,6 +1,11 @@
 from globibot.lib.web.handlers import SessionHandler
 from globibot.lib.web.decorators import authenticated, respond_json, with_query_parameters
 
+from tornado.web import HTTPError
+
+from collections import defaultdict
+from http import HTTPStatus
+
 class GamesTopHandler(SessionHandler):
 
     @authenticated
@@ -38,13 +43,6 @@ def user_data(user_snowflake, servers):
 
     return data
 
-def in_servers(user_id, servers):
-    for server in servers:
-        if server.get_member(str(user_id)):
-            return True
-
-    return False
-
 class GameStatsHandler(SessionHandler):
 
     @authenticated
@@ -59,8 +57,7 @@ class GameStatsHandler(SessionHandler):
                 duration = duration
             )
             for user_id, duration
-            in self.plugin.top_users(name, 1000)
-            if in_servers(user_id, servers)
+            in self.plugin.top_users(name, servers, 1000)
         ]
 
 class GameUserHandler(SessionHandler):
@@ -82,3 +79,61 @@ class GameUserHandler(SessionHandler):
             )
             for game_played in self.plugin.top_user_games(user_id)
         ]
+
+DEFAULT_DAYS = 28
+MAX_DAYS = 365
+
+def days_argument(handler):
+    try:
+        days = int(handler.get_query_argument('days', DEFAULT_DAYS))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST)
+
+    return min(max(days, 1), MAX_DAYS)
+
+class GameHeatmapHandler(SessionHandler):
+
+    @authenticated
+    @respond_json
+    @with_query_parameters('name')
+    def get(self, name):
+        servers = self.bot.servers_of(self.current_user)
+        days = days_argument(self)
+
+        # Played seconds by day of the week (0 is sunday) and hour, in UTC
+        heatmaps = defaultdict(lambda: [[0] * 24 for _ in range(7)])
+        for server_id, day, hour, duration in self.plugin.game_heatmap(name, servers, days):
+            heatmaps[str(server_id)][day][hour] = duration
+
+        return [
+            dict(
+                server_id = server.id,
+                heatmap   = heatmaps[server.id]
+            )
+            for server in servers
+        ]
+
+class GameTrendHandler(SessionHandler):
+
+    @authenticated
+    @respond_json
+    @with_query_parameters('name')
+    def get(self, name):
+        servers = self.bot.servers_of(self.current_user)
+        days = days_argument(self)
+
+        trends = defaultdict(list)
+        for server_id, day, duration, sessions in self.plugin.game_trend(name, servers, days):
+            trends[str(server_id)].append(dict(
+                day      = day,
+                duration = duration,
+                sessions = sessions
+            ))
+
+        return [
+            dict(
+                server_id = server.id,
+                trend     = trends[server.id]
+            )
+            for server in servers
+        ]
@@ -7,10 +7,14 @@ from globibot.lib.helpers.hooks import master_only
 
 from . import queries as q
 
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+from datetime import datetime
 from time import time
 
-from .handlers import GamesTopHandler, GameStatsHandler, GameUserHandler
+from .handlers import (
+    GamesTopHandler, GameStatsHandler, GameUserHandler,
+    GameHeatmapHandler, GameTrendHandler
+)
 
 import asyncio
 
@@ -19,9 +23,17 @@ GamePlayed = namedtuple(
     ['id', 'author_id', 'name', 'duration', 'created_at']
 )
 
+HOUR = 60 * 60
+
+def execute_batches(trans, query, rows, size):
+    for i in range(0, len(rows), size):
+        batch = rows[i:i + size]
+        trans.execute(query(len(batch)), batch)
+
 class Stats(Plugin):
 
     GAME_DUMP_INTERVAL = 60 * 10
+    BATCH_SIZE = 1000
 
     def load(self):
         context = dict(bot=self.bot, plugin=self)
@@ -30,14 +42,23 @@ class Stats(Plugin):
             (r'/stats/games/top', GamesTopHandler, context),
             (r'/stats/games/game', GameStatsHandler, context),
             (r'/stats/games/user/(?P<user_id>\d+)', GameUserHandler, context),
+            (r'/stats/games/heatmap', GameHeatmapHandler, context),
+            (r'/stats/games/trend', GameTrendHandler, context),
         )
 
         self.game_times_by_id = dict()
+        self.member_servers = defaultdict(set)
+        # Played time waiting to be written, by (user id, game name)
+        self.pending_game_times = defaultdict(float)
+        # [played time, ended sessions] by (server id, game name, hour)
+        self.pending_game_hours = defaultdict(lambda: [0.0, 0])
 
         now = time()
 
         for server in self.bot.servers:
+            self.sync_members(server)
             for member in server.members:
+                self.member_servers[member.id].add(server.id)
                 if member.game and member.game.name:
                     game_timer = (member.game.name.lower(), now)
                     self.game_times_by_id[member.id] = game_timer
@@ -51,6 +72,34 @@ class Stats(Plugin):
         if before.game != after.game:
             self.update_game(after.id, after.game)
 
+    async def on_member_join(self, member):
+        self.member_servers[member.id].add(member.server.id)
+
+        with self.transaction() as trans:
+            trans.execute(q.add_members(1), [(member.server.id, member.id)])
+
+    async def on_member_remove(self, member):
+        self.member_servers[member.id].discard(member.server.id)
+
+        with self.transaction() as trans:
+            trans.execute(q.remove_member, dict(
+                server_id = member.server.id,
+                author_id = member.id
+            ))
+
+    async def on_server_join(self, server):
+        for member in server.members:
+            self.member_servers[member.id].add(server.id)
+
+        self.sync_members(server)
+
+    async def on_server_remove(self, server):
+        for member in server.members:
+            self.member_servers[member.id].discard(server.id)
+
+        with self.transaction() as trans:
+            trans.execute(q.remove_server_members, dict(server_id=server.id))
+
     '''
     Commands
     '''
@@ -70,6 +119,7 @@ class Stats(Plugin):
 
         # Flush current tracking
         self.update_game(member.id, member.game)
+        self.dump_all()
 
         games = self.top_user_games(user_id)
         top = [(game.name, game.duration) for game in games[:10]]
@@ -115,20 +165,22 @@ class Stats(Plugin):
     '''
 
     def top_games(self, server, count):
-        user_ids = tuple(member.id for member in server.members)
-
         with self.transaction() as trans:
             trans.execute(q.top_games, dict(
                 limit = count,
-                authors_id = user_ids
+                server_id = server.id
             ))
 
             return trans.fetchall()
 
-    def top_users(self, game, count):
+    def top_users(self, game, servers, count):
+        if not servers:
+            return []
+
         with self.transaction() as trans:
             trans.execute(q.top_users, dict(
                 name = game,
+                servers_id = tuple(server.id for server in servers),
                 limit = count
             ))
 
@@ -142,39 +194,147 @@ class Stats(Plugin):
 
             return [GamePlayed(*row) for row in trans.fetchall()]
 
+    def game_heatmap(self, game, servers, days):
+        if not servers:
+            return []
+
+        with self.transaction() as trans:
+            trans.execute(q.game_heatmap, dict(
+                name = game,
+                servers_id = tuple(server.id for server in servers),
+                days = days
+            ))
+
+            return trans.fetchall()
+
+    def game_trend(self, game, servers, days):
+        if not servers:
+            return []
+
+        with self.transaction() as trans:
+            trans.execute(q.game_trend, dict(
+                name = game,
+                servers_id = tuple(server.id for server in servers),
+                days = days
+            ))
+
+            return trans.fetchall()
+
     def update_game(self, user_id, new_game):
+        now = time()
+
         try:
             game_name, start = self.game_times_by_id[user_id]
-            self.add_game_time(user_id, game_name, start)
         except KeyError:
             pass
+        else:
+            self.add_game_time(user_id, game_name, start, now, ended=True)
 
         if new_game and new_game.name:
-            self.game_times_by_id[user_id] = (new_game.name.lower(), time())
+            self.game_times_by_id[user_id] = (new_game.name.lower(), now)
         else:
             self.game_times_by_id.pop(user_id, None)
 
-    def add_game_time(self, user_id, game_name, start):
-        duration = int(time() - start)
+    def add_game_time(self, user_id, game_name, start, end, ended=False):
+        self.pending_game_times[(user_id, game_name)] += end - start
 
-        with self.transaction() as trans:
-            trans.execute(q.add_game_times(1), [(user_id, game_name, duration)])
+        for server_id in self.member_servers.get(user_id, ()):
+            self.add_game_hours(server_id, game_name, start, end, ended)
+
+    def add_game_hours(self, server_id, game_name, start, end, ended):
+        hour = start - start % HOUR
+
+        # Sessions spanning several hours are split across their buckets
+        while hour < end:
+            played = min(end, hour + HOUR) - max(start, hour)
+            self.pending_game_hours[(server_id, game_name, hour)][0] += played
+            hour += HOUR
+
+        # Sessions are counted in the hour they ended
+        if ended and end > start:
+            hour = end - end % HOUR
+            self.pending_game_hours[(server_id, game_name, hour)][1] += 1
 
     def dump_all(self):
         now = time()
 
-        data = [
-            (user_id, game_name, now - start) for
-            user_id, (game_name, start) in self.game_times_by_id.items()
+        # Ongoing sessions are accounted for up to now
+        for user_id, (game_name, start) in self.game_times_by_id.items():
+            self.add_game_time(user_id, game_name, start, now)
+            self.game_times_by_id[user_id] = (game_name, now)
+
+        pending_times = self.pending_game_times
+        pending_hours = self.pending_game_hours
+        self.pending_game_times = defaultdict(float)
+        self.pending_game_hours = defaultdict(lambda: [0.0, 0])
+
+        # One row per key: a single upsert cannot touch a row twice
+        times = [
+            (user_id, game_name, int(round(duration)))
+            for (user_id, game_name), duration in pending_times.items()
+        ]
+        hours = [
+            (
+                server_id, game_name, datetime.utcfromtimestamp(hour),
+                int(round(duration)), sessions
+            )
+            for (server_id, game_name, hour), (duration, sessions)
+            in pending_hours.items()
         ]
 
-        with self.transaction() as trans:
-            trans.execute(q.add_game_times(len(data)), data)
+        if not times and not hours:
+            return
 
-        for user_id, (game_name, start) in self.game_times_by_id.items():
-            self.game_times_by_id[user_id] = (game_name, now)
+        try:
+            with self.transaction() as trans:
+                execute_batches(trans, q.add_game_times, times, Stats.BATCH_SIZE)
+                execute_batches(trans, q.add_game_hours, hours, Stats.BATCH_SIZE)
+        except:
+            # Kept for the next dump
+            for key, duration in pending_times.items():
+                self.pending_game_times[key] += duration
+            for key, (duration, sessions) in pending_hours.items():
+                self.pending_game_hours[key][0] += duration
+                self.pending_game_hours[key][1] += sessions
+            raise
+
+        self.debug(
+            'Dumped {} game times and {} hourly buckets'
+                .format(len(times), len(hours))
+        )
+
+    def sync_members(self, server):
+        '''
+        Brings the stored members of a server up to date, they may have
+        changed while we were not listening
+        Only the difference is written, which is usually next to nothing
+        '''
+        members = set(int(member.id) for member in server.members)
+
+        with self.transaction() as trans:
+            trans.execute(q.get_server_members, dict(server_id=server.id))
+            stored = set(author_id for author_id, in trans.fetchall())
+
+            joined = [(server.id, author_id) for author_id in members - stored]
+            execute_batches(trans, q.add_members, joined, Stats.BATCH_SIZE)
+
+            left = list(stored - members)
+            for i in range(0, len(left), Stats.BATCH_SIZE):
+                trans.execute(q.remove_members, dict(
+                    server_id = server.id,
+                    authors_id = tuple(left[i:i + Stats.BATCH_SIZE])
+                ))
+
+        if joined or left:
+            self.debug(
+                '{}: {} members joined and {} left since last sync'
+                    .format(server.name, len(joined), len(left))
+            )
 
     async def dump_periodically(self):
         while True:
             await asyncio.sleep(Stats.GAME_DUMP_INTERVAL)
-            self.dump_all()
+            try:
+                self.dump_all()
+            except Exception as e:
+                self.error('Could not dump game times: {}'.format(e))
@@ -15,18 +15,88 @@ author_games = '''
 '''
 
 top_games = '''
-    select          name, sum(duration), count(author_id)
-        from        game_played_time
-        where       author_id in %(authors_id)s
-        group by    name
-        order by    sum(duration) desc
+    select          game.name, sum(game.duration), count(game.author_id)
+        from        game_played_time game
+        join        server_member member
+            on      member.author_id = game.author_id
+        where       member.server_id = %(server_id)s
+        group by    game.name
+        order by    sum(game.duration) desc
         limit       %(limit)s
 '''
 
 top_users = '''
     select          author_id, duration
-        from        game_played_time
+        from        game_played_time game
         where       name = %(name)s
+            and     exists (
+                select  1
+                from    server_member member
+                where   member.author_id = game.author_id
+                    and member.server_id in %(servers_id)s
+            )
         order by    duration desc
         limit       %(limit)s
 '''
+
+add_members = lambda count: '''
+    insert into     server_member (server_id, author_id)
+    values          {}
+    on conflict     do nothing
+'''.format(','.join(['%s'] * count))
+
+remove_member = '''
+    delete from     server_member
+        where       server_id = %(server_id)s
+            and     author_id = %(author_id)s
+'''
+
+get_server_members = '''
+    select          author_id
+        from        server_member
+        where       server_id = %(server_id)s
+'''
+
+remove_members = '''
+    delete from     server_member
+        where       server_id = %(server_id)s
+            and     author_id in %(authors_id)s
+'''
+
+remove_server_members = '''
+    delete from     server_member
+        where       server_id = %(server_id)s
+'''
+
+add_game_hours = lambda count: '''
+    insert into     game_played_hour (server_id, name, hour, duration, sessions)
+    values          {}
+    on conflict     (server_id, name, hour)
+    do update set   duration = game_played_hour.duration + EXCLUDED.duration,
+                    sessions = game_played_hour.sessions + EXCLUDED.sessions
+'''.format(','.join(['%s'] * count))
+
+game_heatmap = '''
+    select          server_id,
+                    extract(dow from hour)::int,
+                    extract(hour from hour)::int,
+                    sum(duration)
+        from        game_played_hour
+        where       name = %(name)s
+            and     server_id in %(servers_id)s
+            and     hour >= (now() at time zone 'utc') - %(days)s * interval '1 day'
+        group by    1, 2, 3
+'''
+
+game_trend = '''
+    select          server_id,
+                    extract(epoch from date_trunc('day', hour))::bigint,
+                    sum(duration),
+                    sum(sessions)
+        from        game_played_hour
+        where       name = %(name)s
+            and     server_id in %(servers_id)s
+            and     hour >= (now() at time zone 'utc') - %(days)s * interval '1 day'
+        group by    1, 2
+        order by    2
+'''
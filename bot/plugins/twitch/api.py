@@ -3,20 +3,29 @@ from tornado.httputil import url_concat
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.platform.asyncio import to_asyncio_future
 
+from globibot.lib.helpers.cache import LRUCache
+from globibot.lib.helpers.single_flight import SingleFlight
+
 from collections import namedtuple
+from functools import lru_cache
+
+import asyncio
 
 def unpack_value(k, v):
     if type(v) is dict:
         return struct_from_dict(k.title(), v)
     return v
 
+# Responses of a given endpoint always share the same few schemas so record
+# types are built once per (name, fields) and reused
+@lru_cache(maxsize=512)
+def record_type(name, fields):
+    return namedtuple(name, fields)
+
 def struct_from_dict(name, d):
-    stripped_dict = dict([
-        (k, unpack_value(k, v)) for k, v in d.items()
-        if not k.startswith('_')
-    ])
+    fields = tuple(sorted(k for k in d if not k.startswith('_')))
 
-    return namedtuple(name, stripped_dict.keys())(*stripped_dict.values())
+    return record_type(name, fields)(*(unpack_value(k, d[k]) for k in fields))
 
 class TwitchAPI:
 
@@ -24,78 +33,147 @@ class TwitchAPI:
 
     OBJECT_BUILDER = lambda name: lambda d: struct_from_dict(name, d)
 
+    RESPONSE_CACHE_SIZE = 1024
+
     def __init__(self, client_id, debug):
         self.client_id = client_id
         self.debug = debug
 
         self.client = AsyncHTTPClient()
 
+        self.responses = LRUCache(TwitchAPI.RESPONSE_CACHE_SIZE)
+        self.pending_requests = SingleFlight()
+
     TOP_GAMES_ENDPOINT = '/games/top'
+    TOP_GAMES_TTL = 60
     TopGame = OBJECT_BUILDER('TopGame')
     async def top_games(self, count):
         json = await self.get_json(TwitchAPI.TOP_GAMES_ENDPOINT, dict(
             limit=min(count, 100)
-        ))
+        ), ttl=TwitchAPI.TOP_GAMES_TTL)
 
         return list(map(TwitchAPI.TopGame, json['top']))
 
     STREAMS_ENDPOINT = '/streams'
+    STREAMS_TTL = 30
     Stream = OBJECT_BUILDER('Stream')
     async def top_channels(self, count):
         json = await self.get_json(TwitchAPI.STREAMS_ENDPOINT, dict(
             limit=min(count, 100)
-        ))
+        ), ttl=TwitchAPI.STREAMS_TTL)
 
         return list(map(TwitchAPI.Stream, json['streams']))
 
+    STREAMS_BATCH_SIZE = 100
+    async def streams(self, names):
+        '''
+        Looks up the live streams of several channels at once
+        Returns a dict mapping channel names to streams, offline channels are
+        left out
+        '''
+        names = sorted(set(name.lower() for name in names))
+        batch_size = TwitchAPI.STREAMS_BATCH_SIZE
+        batches = [
+            names[i:i + batch_size]
+            for i in range(0, len(names), batch_size)
+        ]
+
+        jsons = await asyncio.gather(*(
+            self.get_json(TwitchAPI.STREAMS_ENDPOINT, dict(
+                channel = ','.join(batch),
+                limit   = batch_size
+            ), ttl=TwitchAPI.STREAMS_TTL)
+            for batch in batches
+        ))
+
+        streams = (
+            TwitchAPI.Stream(stream)
+            for json in jsons
+            for stream in json['streams']
+        )
+
+        return dict((stream.channel.name, stream) for stream in streams)
+
     STREAM_ENDPOINT = lambda name: '{}/{}'.format(TwitchAPI.STREAMS_ENDPOINT, name)
     async def stream(self, name):
-        json = await self.get_json(TwitchAPI.STREAM_ENDPOINT(name))
+        json = await self.get_json(
+            TwitchAPI.STREAM_ENDPOINT(name),
+            ttl = TwitchAPI.STREAMS_TTL
+        )
 
         stream = json['stream']
         if stream:
             return TwitchAPI.Stream(stream)
 
     CHANNEL_ENDPOINT = lambda name: '/channels/{}'.format(name)
+    CHANNEL_TTL = 60 * 5
     Channel = OBJECT_BUILDER('Channel')
     async def channel(self, name):
-        json = await self.get_json(TwitchAPI.CHANNEL_ENDPOINT(name))
+        json = await self.get_json(
+            TwitchAPI.CHANNEL_ENDPOINT(name),
+            ttl = TwitchAPI.CHANNEL_TTL
+        )
 
         return TwitchAPI.Channel(json)
 
     USER_ENDPOINT = '/user'
     USER_FOLLOWED_ENDPOINT = lambda user: '/users/{}/follows/channels'.format(user)
+    USER_TTL = 60
     Follow = OBJECT_BUILDER('Follow')
     async def user_followed(self, token):
-        user = await self.get_json(TwitchAPI.USER_ENDPOINT, token=token)
+        user = await self.get_json(
+            TwitchAPI.USER_ENDPOINT,
+            token = token,
+            ttl   = TwitchAPI.USER_TTL
+        )
 
         json = await self.get_json(
             TwitchAPI.USER_FOLLOWED_ENDPOINT(user['name']),
             params = dict(limit=100),
+            ttl    = TwitchAPI.USER_TTL
         )
 
         return list(map(TwitchAPI.Follow, json['follows']))
 
     VODS_ENDPOINT = lambda channel: '/channels/{}/videos'.format(channel)
+    VODS_TTL = 60 * 5
     Vod = OBJECT_BUILDER('Vod')
     async def vods(self, name):
         json = await self.get_json(TwitchAPI.VODS_ENDPOINT(name), dict(
             broadcasts='true'
-        ))
+        ), ttl=TwitchAPI.VODS_TTL)
 
         return list(map(TwitchAPI.Vod, json['videos']))
 
-    async def get_json(self, endpoint, params={}, token=None):
+    async def get_json(self, endpoint, params={}, token=None, ttl=None):
         url = url_concat(TwitchAPI.BASE_URL + endpoint, params)
+        key = (url, token)
+
+        try:
+            return self.responses[key]
+        except KeyError:
+            pass
+
+        # Concurrent identical requests share a single fetch
+        return await self.pending_requests.run(
+            key, self.fetch_json, key, url, token, ttl
+        )
+
+    async def fetch_json(self, key, url, token, ttl):
         request = HTTPRequest(
             url     = url,
             headers = self.api_headers(token)
         )
+
         tornado_future = self.client.fetch(request)
         future = to_asyncio_future(tornado_future)
         response = await future
 
-        return json_decode(response.body)
+        json = json_decode(response.body)
+        if ttl:
+            self.responses.set(key, json, ttl=ttl)
+
+        return json
 
     '''
     Details
@@ -0,0 +1,69 @@
+from time import time
+
+import asyncio
+
+class RateLimiter:
+    '''
+    Hands out evenly spaced slots, at most `rate` per `per` seconds
+    '''
+
+    def __init__(self, rate, per):
+        self.interval = per / rate
+        self.next_slot = 0
+
+    async def wait(self):
+        now = time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+
+        await asyncio.sleep(slot - now)
+
+class FanOut:
+    '''
+    Sends the same message to many users with bounded concurrency while
+    staying under Discord's direct message rate limit
+    '''
+
+    CONCURRENCY = 5
+    RATE = 5
+    PER = 1
+    PROGRESS_EVERY = 100
+
+    def __init__(self, send_message, info):
+        self.send_message = send_message
+        self.info = info
+
+        # Shared across fan-outs: the rate limit is per bot, not per alert
+        self.limiter = RateLimiter(FanOut.RATE, FanOut.PER)
+
+    async def send_all(self, description, users, content, **kwargs):
+        semaphore = asyncio.Semaphore(FanOut.CONCURRENCY)
+        started = time()
+        sent = 0
+        failed = 0
+
+        async def send(user):
+            nonlocal sent, failed
+
+            async with semaphore:
+                await self.limiter.wait()
+                message = await self.send_message(user, content, **kwargs)
+
+            if message:
+                sent += 1
+            else:
+                failed += 1
+
+            done = sent + failed
+            if done % FanOut.PROGRESS_EVERY == 0 and done < len(users):
+                self.info(
+                    '{}: {}/{} sent in {:.1f}s'
+                        .format(description, done, len(users), time() - started)
+                )
+
+        await asyncio.gather(*map(send, users))
+
+        self.info(
+            '{}: {} sent, {} failed in {:.1f}s'
+                .format(description, sent, failed, time() - started)
+        )
@@ -9,6 +9,7 @@ from . import queries as q
 from . import constants as c
 from .api import TwitchAPI
 from .pubsub import PubSub
+from .fanout import FanOut
 from .handlers import TwitchStatusHandler, OAuthRequestTokenHandler, \
     OAuthAuthorizeHandler, TwitchDisconnectHandler, TwitchFollowedHandler, \
     TwitchMentionHandler, TwitchWhisperHandler
@@ -17,7 +18,8 @@ from tornado.escape import json_decode
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.platform.asyncio import to_asyncio_future
 
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+from functools import partial
 from urllib.parse import urlencode
 
 from discord import Embed
@@ -88,9 +90,18 @@ class Twitch(Plugin):
             self.warning('Missing client id: API calls might not work')
 
         self.api = TwitchAPI(self.client_id, self.debug)
-        self.pubsub = PubSub(self.debug, self.run_async)
+        self.pubsub = PubSub(self.debug, self.warning, self.run_async)
+        self.fanout = FanOut(self.send_message, self.info)
 
         self.channels_info = dict()
+
+        # Subscription indexes, kept in sync with the database so that read
+        # paths never have to query it
+        self.whispered_users = defaultdict(dict)
+        self.mentioned_users = defaultdict(set)
+        self.monitored_channels = defaultdict(set)
+        self.user_notifications = defaultdict(set)
+
         self.restore_monitored()
 
         context = dict(plugin=self, bot=self.bot)
@@ -119,10 +130,11 @@ class Twitch(Plugin):
 
     @command(twitch_prefix + p.string('status') + p.bind(p.word, 'name'))
     async def twitch_channel_status(self, message, name):
-        stream, channel = await asyncio.gather(
-            self.api.stream(name),
-            self.api.channel(name)
-        )
+        streams = await self.api.streams([name])
+
+        # Live streams already carry their channel
+        stream = streams.get(name.lower())
+        channel = stream.channel if stream else await self.api.channel(name)
 
         response = '`{name}` is __{status}__'
         info = dict(
@@ -200,7 +212,8 @@ class Twitch(Plugin):
                 server_id = message.server.id
             ))
 
-            self.run_async(self.monitor_forever(channel.name, message.server))
+            self.index_monitored(message.server.id, channel.name, True)
+            self.run_async(self.monitor(channel.name, message.server))
 
             await self.send_message(
                 message.channel,
@@ -226,6 +239,9 @@ class Twitch(Plugin):
                 server_id = message.server.id
             ))
 
+            self.index_monitored(message.server.id, channel.name, False)
+            self.info('Stopped monitoring: {}'.format(channel.name))
+
             await self.send_message(
                 message.channel,
                 'Stopped monitoring `{}`'.format(channel.display_name),
@@ -234,126 +250,200 @@ class Twitch(Plugin):
 
     @command(twitch_prefix + p.string('monitored'), master_only)
     async def monitored(self, message):
-        with self.transaction() as trans:
-            trans.execute(q.get_monitored)
-            monitored = [MonitoredChannel(*row) for row in trans.fetchall()]
-
-            channels = [
-                channel.name for channel in monitored
-                if str(channel.server_id) == message.server.id
-            ]
+        channels = sorted(self.monitored_channels.get(message.server.id, ()))
 
-            await self.send_message(
-                message.channel,
-                'I\'m currently monitoring the following channels:\n{}'
-                    .format(f.code_block(channels)),
-                delete_after=15
-            )
+        await self.send_message(
+            message.channel,
+            'I\'m currently monitoring the following channels:\n{}'
+                .format(f.code_block(channels)),
+            delete_after=15
+        )
 
     '''
     Details
     '''
 
     CHANNELS_INFO_REFRESH_INTERVAL = 60 * 10
+    CHANNELS_INFO_REFRESH_BATCH_SIZE = 50
+    CHANNELS_INFO_REFRESH_CONCURRENCY = 8
     async def refresh_channels_info_forever(self):
         while True:
-            await asyncio.sleep(Twitch.CHANNELS_INFO_REFRESH_INTERVAL)
-            for channel_name in self.channels_info:
+            channel_names = list(self.channels_info)
+            batch_size = Twitch.CHANNELS_INFO_REFRESH_BATCH_SIZE
+            batches = [
+                channel_names[i:i + batch_size]
+                for i in range(0, len(channel_names), batch_size)
+            ]
+
+            # Spread the batches over the whole interval instead of
+            # refreshing everything at once
+            delay = Twitch.CHANNELS_INFO_REFRESH_INTERVAL / max(len(batches), 1)
+            for batch in batches or [[]]:
+                await asyncio.sleep(delay * random.uniform(0.9, 1.1))
+                if batch:
+                    await self.refresh_channels_info(batch)
+
+    async def refresh_channels_info(self, channel_names):
+        try:
+            streams = await self.api.streams(channel_names)
+        except Exception as e:
+            self.warning('Failed to fetch live streams: {}'.format(e))
+            streams = dict()
+
+        for channel_name in channel_names:
+            try:
+                stream = streams[channel_name.lower()]
+            except KeyError:
+                pass
+            else:
+                self.channels_info[channel_name] = stream.channel
+
+        semaphore = asyncio.Semaphore(Twitch.CHANNELS_INFO_REFRESH_CONCURRENCY)
+        async def refresh(channel_name):
+            async with semaphore:
                 await self.refresh_channel_info(channel_name)
 
+        offline_names = [
+            channel_name for channel_name in channel_names
+            if channel_name.lower() not in streams
+        ]
+        results = await asyncio.gather(
+            *map(refresh, offline_names),
+            return_exceptions=True
+        )
+
+        for channel_name, result in zip(offline_names, results):
+            if isinstance(result, Exception):
+                self.warning(
+                    'Failed to refresh channel {}: {}'
+                        .format(channel_name, result)
+                )
+
     async def refresh_channel_info(self, channel_name):
         channel = await self.api.channel(channel_name)
         self.channels_info[channel_name] = channel
 
-    async def monitor_forever(self, channel_name, server):
+    async def monitor(self, channel_name, server):
         self.info('Monitoring: {}'.format(channel_name))
 
         await self.refresh_channel_info(channel_name)
-        events = await self.pubsub.subscribe(
+        await self.pubsub.subscribe(
             PubSub.Topics.VIDEO_PLAYBACK(channel_name),
-            server.id
+            server.id,
+            partial(self.on_monitored_event, channel_name, server)
         )
 
-        async for event in events:
-            channel = self.channels_info[channel_name]
-            if event['type'] == 'stream-up':
-                users = self.users_to_mention(channel.name, server)
-                mentions = ' '.join(f.mention(user_id) for user_id in users)
-                await self.send_message(
-                    server.default_channel, '{}\nWake up!'.format(mentions),
-                    embed = twitch_alert_embed(channel, True)
-                )
-
-            if event['type'] == 'stream-down':
-                await self.send_message(
-                    server.default_channel,
-                    '`{}` just went offline 😢'.format(channel.display_name)
-                )
+    # All the whispers of a channel share a single subscription
+    WHISPERS_REQUEST_ID = 'whispers'
 
-        self.info('Stopped monitoring: {}'.format(channel_name))
+    async def whisper_monitor(self, channel_name, user):
+        self.whispered_users[channel_name][user.id] = user
 
-    async def whisper_monitor_forever(self, channel_name, user):
         await self.refresh_channel_info(channel_name)
 
-        events = await self.pubsub.subscribe(
+        await self.pubsub.subscribe(
             PubSub.Topics.VIDEO_PLAYBACK(channel_name),
-            user.id
+            Twitch.WHISPERS_REQUEST_ID,
+            partial(self.on_whispered_event, channel_name)
         )
 
-        async for event in events:
-            if event['type'] == 'stream-up':
-                await self.send_message(
-                    user, 'Just a heads up',
-                    embed = twitch_alert_embed(self.channels_info[channel_name])
-                )
+    async def whisper_unmonitor(self, channel_name, user):
+        users = self.whispered_users.get(channel_name)
+        if users is None:
+            return
 
-    def users_to_mention(self, channel_name, server):
-        with self.transaction() as trans:
-            trans.execute(q.get_subscribed_users, dict(
-                channel = channel_name,
-                method = 'mention'
-            ))
+        users.pop(user.id, None)
 
-            return [
-                user_id for user_id, in trans.fetchall()
-                if server in self.bot.servers_of(
-                    self.bot.find_user(str(user_id))
-                )
-            ]
+        if not users:
+            del self.whispered_users[channel_name]
+            await self.pubsub.unsubscribe(
+                PubSub.Topics.VIDEO_PLAYBACK(channel_name),
+                Twitch.WHISPERS_REQUEST_ID
+            )
 
-        return []
+    async def on_monitored_event(self, channel_name, server, event):
+        channel = self.channels_info[channel_name]
+        if event['type'] == 'stream-up':
+            users = self.users_to_mention(channel.name, server)
+            mentions = ' '.join(f.mention(user_id) for user_id in users)
+            await self.send_message(
+                server.default_channel, '{}\nWake up!'.format(mentions),
+                embed = twitch_alert_embed(channel, True)
+            )
 
-    def users_to_whisper(self, channel_name):
-        with self.transaction() as trans:
-            trans.execute(q.get_subscribed_users, dict(
-                channel = channel_name,
-                method = 'whisper'
+        if event['type'] == 'stream-down':
+            await self.send_message(
+                server.default_channel,
+                '`{}` just went offline 😢'.format(channel.display_name)
+            )
+
+    async def on_whispered_event(self, channel_name, event):
+        if event['type'] == 'stream-up':
+            users = list(self.whispered_users.get(channel_name, {}).values())
+
+            # Don't hold up the other subscribers of the topic
+            self.run_async(self.fanout.send_all(
+                'Whispering {} going live'.format(channel_name),
+                users,
+                'Just a heads up',
+                embed = twitch_alert_embed(self.channels_info[channel_name])
             ))
 
-            return [user_id for user_id, in trans.fetchall()]
+    def users_to_mention(self, channel_name, server):
+        return [
+            user_id for user_id in self.mentioned_users.get(channel_name, ())
+            if server.get_member(user_id)
+        ]
+
+    def index_notify(self, user_id, channel_name, method, state):
+        # Whispers are indexed by whisper_monitor, along with their user
+        notified = NotifiedChannel(channel_name, method)
 
-        return []
+        if state:
+            if method == 'mention':
+                self.mentioned_users[channel_name].add(user_id)
+            self.user_notifications[user_id].add(notified)
+        else:
+            if method == 'mention':
+                self.mentioned_users[channel_name].discard(user_id)
+            self.user_notifications[user_id].discard(notified)
+
+    def index_monitored(self, server_id, channel_name, state):
+        if state:
+            self.monitored_channels[server_id].add(channel_name)
+        else:
+            self.monitored_channels[server_id].discard(channel_name)
 
     def restore_monitored(self):
         with self.transaction() as trans:
-            # Server monitors
             trans.execute(q.get_monitored)
             monitored = [MonitoredChannel(*row) for row in trans.fetchall()]
 
-            for channel in monitored:
-                server = next(
-                    serv for serv in self.bot.servers
-                    if serv.id == str(channel.server_id)
-                )
-                self.run_async(self.monitor_forever(channel.name, server))
+            trans.execute(q.get_all_notify)
+            notifies = trans.fetchall()
+
+        # Server monitors
+        for channel in monitored:
+            self.index_monitored(str(channel.server_id), channel.name, True)
+
+        for server in self.bot.servers:
+            for channel_name in self.monitored_channels.get(server.id, ()):
+                self.run_async(self.monitor(channel_name, server))
+
+        # Notifications
+        for user_id, channel_name, method in notifies:
+            self.index_notify(str(user_id), channel_name, method, True)
 
-            # Whispers
-            trans.execute(q.get_all_notify_whispers)
+        members = dict(
+            (member.id, member)
+            for server in self.bot.servers
+            for member in server.members
+        )
 
-            for user_id, channel_name in trans.fetchall():
-                user = self.bot.find_user(str(user_id))
-                if user:
-                    self.run_async(self.whisper_monitor_forever(channel_name, user))
+        for user_id, channel_name, method in notifies:
+            user = members.get(str(user_id))
+            if method == 'whisper' and user:
+                self.run_async(self.whisper_monitor(channel_name, user))
 
     def request_token_state(self, user):
         state = ''.join(
@@ -429,37 +519,29 @@ class Twitch(Plugin):
 
         followed = await self.api.user_followed(token)
 
-        user_servers = self.bot.servers_of(user)
-        with self.transaction() as trans:
-            trans.execute(q.get_monitored_names, dict(
-                server_ids = tuple(server.id for server in user_servers)
-            ))
-
-            monitored_names = set(name for name, in trans.fetchall())
-
-            trans.execute(q.get_notified, dict(
-                id = user.id,
-            ))
-
-            notifieds = [NotifiedChannel(*row) for row in trans.fetchall()]
-            whipered = [
-                notified.name for notified in notifieds
-                if notified.method == 'whisper'
-            ]
-            mentionned = [
-                notified.name for notified in notifieds
-                if notified.method == 'mention'
-            ]
+        monitored_names = set(
+            name for server in self.bot.servers
+            if server.get_member(user.id)
+            for name in self.monitored_channels.get(server.id, ())
+        )
 
-            followed_channels = [ChannelState(f.channel.name, f.channel.name in whipered) for f in followed]
-            monitored_channels = [ChannelState(name, name in mentionned) for name in monitored_names]
+        notifieds = self.user_notifications.get(user.id, ())
+        whipered = [
+            notified.name for notified in notifieds
+            if notified.method == 'whisper'
+        ]
+        mentionned = [
+            notified.name for notified in notifieds
+            if notified.method == 'mention'
+        ]
 
-            return (
-                followed_channels,
-                monitored_channels
-            )
+        followed_channels = [ChannelState(f.channel.name, f.channel.name in whipered) for f in followed]
+        monitored_channels = [ChannelState(name, name in mentionned) for name in monitored_names]
 
-        return ([], [])
+        return (
+            followed_channels,
+            monitored_channels
+        )
 
     def get_user_token(self, user):
         with self.transaction() as trans:
@@ -479,6 +561,8 @@ class Twitch(Plugin):
         with self.transaction() as trans:
             trans.execute(query, payload)
 
+        self.index_notify(user.id, channel, 'mention', state)
+
     async def user_notify_whisper(self, user, channel, state):
         payload = dict(
             id = user.id,
@@ -490,10 +574,9 @@ class Twitch(Plugin):
         with self.transaction() as trans:
             trans.execute(query, payload)
 
-            if state:
-                self.run_async(self.whisper_monitor_forever(channel, user))
-            else:
-                await self.pubsub.unsubscribe(
-                    PubSub.Topics.VIDEO_PLAYBACK(channel),
-                    user.id
-                )
+        self.index_notify(user.id, channel, 'whisper', state)
+
+        if state:
+            self.run_async(self.whisper_monitor(channel, user))
+        else:
+            await self.whisper_unmonitor(channel, user)
@@ -1,5 +1,3 @@
-from collections import defaultdict
-
 import json
 import random
 import string
@@ -32,17 +30,26 @@ def unlisten_order(*topics):
     )
 
 class QueueIterator:
+    '''
+    Bounded queue: once full, the oldest items are dropped to make room
+    '''
 
-    def __init__(self):
-        self.queue = asyncio.Queue()
+    def __init__(self, maxsize=0):
+        self.queue = asyncio.Queue(maxsize)
         self.stop_next = False
+        self.dropped = 0
+
+    def put(self, item):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.queue.task_done()
+            self.dropped += 1
 
-    async def put(self, item):
-        await self.queue.put(item)
+        self.queue.put_nowait(item)
 
-    async def stop(self):
+    def stop(self):
         self.stop_next = True
-        await self.queue.put('dummy item')
+        self.put('dummy item')
 
     async def __aiter__(self):
         return self
@@ -56,6 +63,144 @@ class QueueIterator:
 
         return item
 
+class PubSubConnection:
+    '''
+    A single PubSub websocket, listening to at most MAX_TOPICS topics
+    Reconnects with a jittered backoff when the socket drops and replays its
+    LISTEN set once connected again
+    '''
+
+    MAX_TOPICS = 50
+    PING_INTERVAL = 60 * 4
+    PONG_TIMEOUT = 10
+    RECONNECT_BACKOFF = 1
+    RECONNECT_BACKOFF_MAX = 60 * 2
+
+    def __init__(self, on_data, debug, warning, run_async):
+        self.on_data = on_data
+        self.debug = debug
+        self.warning = warning
+        self.run_async = run_async
+
+        self.topics = set()
+        self.pending_orders = dict()
+        self.ws = None
+        self.running = False
+        self.pong_received = True
+
+    @property
+    def full(self):
+        return len(self.topics) >= PubSubConnection.MAX_TOPICS
+
+    async def listen(self, topic):
+        self.topics.add(topic)
+
+        if not self.running:
+            self.running = True
+            self.run_async(self.run_forever())
+        elif self.ws:
+            await self.issue_order(listen_order(topic))
+
+    async def unlisten(self, topic):
+        self.topics.discard(topic)
+
+        if self.ws:
+            await self.issue_order(unlisten_order(topic))
+
+    async def close(self):
+        self.running = False
+
+        if self.ws:
+            await self.ws.close()
+
+    async def run_forever(self):
+        attempts = 0
+
+        while self.running:
+            self.debug('Connecting to PubSub service')
+
+            try:
+                async with websockets.connect(PubSub.WS_URL) as ws:
+                    self.ws = ws
+                    attempts = 0
+
+                    if self.topics:
+                        await self.issue_order(listen_order(*self.topics))
+
+                    pings = asyncio.ensure_future(self.send_pings())
+                    try:
+                        while self.running:
+                            message = await ws.recv()
+                            await self.on_ws_data(json.loads(message))
+                    finally:
+                        pings.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.debug('PubSub connection lost: {}'.format(e))
+
+            self.ws = None
+            self.pending_orders.clear()
+            self.debug('Disconnected from PubSub service')
+
+            if self.running:
+                attempts += 1
+                backoff = min(
+                    PubSubConnection.RECONNECT_BACKOFF * 2 ** attempts,
+                    PubSubConnection.RECONNECT_BACKOFF_MAX
+                )
+                await asyncio.sleep(random.uniform(0, backoff))
+
+    async def on_ws_data(self, data):
+        if data['type'] == 'PONG':
+            self.pong_received = True
+        elif data['type'] == 'RECONNECT':
+            self.debug('PubSub service asked to reconnect')
+            await self.ws.close()
+        elif data['type'] == 'RESPONSE':
+            order = self.pending_orders.pop(data.get('nonce'), None)
+            if order and data.get('error'):
+                self.warning(
+                    '{} {} failed: {}'.format(
+                        order['type'],
+                        ', '.join(order['data']['topics']),
+                        data['error']
+                    )
+                )
+        else:
+            await self.on_data(data)
+
+    async def issue_order(self, order):
+        self.pending_orders[order['nonce']] = order
+
+        try:
+            await self.send_data(order)
+        except Exception:
+            # The LISTEN set is replayed after reconnecting
+            self.debug('Failed to send order')
+
+    async def send_pings(self):
+        ping = dict(type='PING')
+
+        while True:
+            self.pong_received = False
+            await self.send_data(ping)
+            await asyncio.sleep(PubSubConnection.PONG_TIMEOUT)
+
+            if not self.pong_received:
+                self.debug('No PONG received, reconnecting')
+                await self.ws.close()
+                break
+
+            await asyncio.sleep(
+                PubSubConnection.PING_INTERVAL * random.uniform(0.9, 1)
+            )
+
+    async def send_data(self, data):
+        frame = json.dumps(data)
+        self.debug('Sending frame: {}'.format(frame))
+        await self.ws.send(frame)
+
 class PubSub:
 
     WS_URL = 'wss://pubsub-edge.twitch.tv'
@@ -63,73 +208,87 @@ class PubSub:
     class Topics:
         VIDEO_PLAYBACK = lambda name: 'video-playback.{}'.format(name)
 
-    def __init__(self, debug, run_async):
+    EVENT_QUEUE_SIZE = 64
+
+    def __init__(self, debug, warning, run_async):
         self.debug = debug
+        self.warning = warning
         self.run_async = run_async
 
-        self.orders = asyncio.Queue()
-        self.iterators_by_topic = defaultdict(dict)
-        self.ws = None
-        self.service_started = False
+        self.handlers_by_topic = dict()
+        self.events_by_topic = dict()
+        self.connections = []
+        self.connection_by_topic = dict()
 
     async def shutdown(self):
-        for iterators in self.iterators_by_topic.values():
-            for iterator in iterators.values():
-                await iterator.stop()
-
-        if self.ws:
-            await self.ws.close()
-
-    async def subscribe(self, topic, request_id):
-        if not self.iterators_by_topic[topic]:
-            order = listen_order(topic)
-            await self.issue_order(order)
+        for events in self.events_by_topic.values():
+            events.stop()
+
+        for connection in self.connections:
+            await connection.close()
+
+    async def subscribe(self, topic, request_id, handler):
+        '''
+        Registers a coroutine function called with every event of the topic
+        Each topic is dispatched by a single coroutine whatever its number of
+        subscribers
+        '''
+        try:
+            handlers = self.handlers_by_topic[topic]
+        except KeyError:
+            handlers = self.handlers_by_topic[topic] = dict()
+            events = self.events_by_topic[topic] = QueueIterator(PubSub.EVENT_QUEUE_SIZE)
+            self.run_async(self.dispatch_forever(topic, events))
 
-        iterator = QueueIterator()
-        self.iterators_by_topic[topic][request_id] = iterator
+            connection = self.available_connection()
+            self.connection_by_topic[topic] = connection
+            await connection.listen(topic)
 
-        return iterator
+        handlers[request_id] = handler
 
     async def unsubscribe(self, topic, request_id):
         try:
-            iterator = self.iterators_by_topic[topic][request_id]
-            await iterator.stop()
-            del self.iterators_by_topic[topic][request_id]
+            handlers = self.handlers_by_topic[topic]
+            del handlers[request_id]
         except KeyError:
             return
 
-        if not self.iterators_by_topic[topic]:
-            order = unlisten_order(topic)
-            await self.issue_order(order)
+        if not handlers:
+            del self.handlers_by_topic[topic]
+            self.events_by_topic.pop(topic).stop()
 
-    async def issue_order(self, order):
-        if not self.service_started:
-            self.service_started = True
-            self.run_async(self.run_ws())
+            connection = self.connection_by_topic.pop(topic)
+            await connection.unlisten(topic)
 
-        await self.orders.put(order)
+            if not connection.topics:
+                self.connections.remove(connection)
+                await connection.close()
 
-    async def run_ws(self):
-        self.debug('Connecting to PubSub service')
+    def available_connection(self):
+        for connection in self.connections:
+            if not connection.full:
+                return connection
 
-        async with websockets.connect(PubSub.WS_URL) as ws:
-            self.ws = ws
+        connection = PubSubConnection(
+            self.on_ws_data,
+            self.debug, self.warning, self.run_async
+        )
+        self.connections.append(connection)
 
-            self.run_async(self.send_pings())
-            self.run_async(self.process_pubsub_orders())
+        return connection
 
-            while True:
-                try:
-                    message = await self.ws.recv()
-                except:
-                    break
-                data = json.loads(message)
+    async def dispatch_forever(self, topic, events):
+        async for event in events:
+            handlers = list(self.handlers_by_topic.get(topic, dict()).values())
 
-                await self.on_ws_data(data)
+            for handler in handlers:
+                try:
+                    await handler(event)
+                except Exception as e:
+                    self.warning('{} handler failed: {}'.format(topic, e))
 
-        self.ws = None
-        self.service_started = False
-        self.debug('Disconnected from PubSub service')
+        if events.dropped:
+            self.warning('{} dropped {} events'.format(topic, events.dropped))
 
     async def on_ws_data(self, data):
         self.debug('PubSub data received: {}'.format(data))
@@ -137,36 +296,10 @@ class PubSub:
         if data['type'] == 'MESSAGE':
             message_data = data['data']
             topic = message_data['topic']
-            message_content = json.loads(message_data['message'])
-
-            iterators = self.iterators_by_topic[topic]
-            for iterator in iterators.values():
-                await iterator.put(message_content)
-
-    async def process_pubsub_orders(self):
-        while True:
-            order = await self.orders.get()
-            self.orders.task_done()
 
             try:
-                await self.send_data(order)
-            except:
-                self.debug('Failed to send order')
-                break
+                events = self.events_by_topic[topic]
+            except KeyError:
+                return
 
-    async def send_pings(self):
-        ping = dict(type='PING')
-
-        while True:
-            try:
-                await self.send_data(ping)
-            except:
-                self.debug('Failed to send ping')
-                break
-
-            await asyncio.sleep(60 * 4)
-
-    async def send_data(self, data):
-        frame = json.dumps(data)
-        self.debug('Sending frame: {}'.format(frame))
-        await self.ws.send(frame)
+            events.put(json.loads(message_data['message']))
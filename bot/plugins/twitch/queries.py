@@ -30,18 +30,6 @@ delete_user = '''
         where   id = %(id)s
 '''
 
-get_monitored_names = '''
-    select      name
-        from    twitch_monitored_channel
-        where   server_id in %(server_ids)s
-'''
-
-get_notified = '''
-    select      channel, method
-        from    twitch_notify
-        where   id = %(id)s
-'''
-
 user_notify_add = '''
     insert into twitch_notify (id, channel, method)
     values                    (%(id)s, %(channel)s, %(method)s)
@@ -54,15 +42,7 @@ user_notify_remove = '''
         and method = %(method)s
 '''
 
-get_subscribed_users = '''
-    select      id
-        from    twitch_notify
-        where   channel = %(channel)s
-            and method = %(method)s
-'''
-
-get_all_notify_whispers = '''
-    select      id, channel
+get_all_notify = '''
+    select      id, channel, method
         from    twitch_notify
-        where   method = 'whisper'
 '''
@@ -4,6 +4,7 @@ from globibot.lib.decorators import command
 from globibot.lib.helpers import parsing as p
 from globibot.lib.helpers import formatting as f
 from globibot.lib.helpers.hooks import master_only
+from globibot.lib.helpers.cache import LRUCache
 
 from . import constants as c
 from . import queries as q
@@ -57,6 +58,9 @@ PAST_FORMS = {
 
 class Twitter(Plugin):
 
+    USER_API_CACHE_SIZE = 512
+    USER_API_CACHE_TTL = 60 * 60
+
     def load(self):
         self.oauth = OAuth(
             self.config.get(c.ACCESS_TOKEN_KEY),
@@ -83,8 +87,14 @@ class Twitter(Plugin):
 
         self.interactive_tweets = dict()
 
+        self.user_apis = LRUCache(
+            Twitter.USER_API_CACHE_SIZE,
+            ttl=Twitter.USER_API_CACHE_TTL
+        )
+
     def unload(self):
         self.monitored.clear()
+        self.user_apis.clear()
 
     async def on_reaction_add(self, reaction, user):
         try:
@@ -422,18 +432,16 @@ class Twitter(Plugin):
                     secret = params['oauth_token_secret']
                 ))
 
+            self.user_apis.invalidate(user.id)
+
     def disconnect_user(self, user):
         with self.transaction() as trans:
             trans.execute(q.delete_user, dict(id=user.id))
 
-    def user_connected(self, user):
-        with self.transaction() as trans:
-            trans.execute(q.get_user, dict(id=user.id))
+        self.user_apis.invalidate(user.id)
 
-            if trans.fetchone():
-                return True
-
-        return False
+    def user_connected(self, user):
+        return self.get_user_api(user) is not None
 
     def get_user_oauth(self, user):
         with self.transaction() as trans:
@@ -443,7 +451,21 @@ class Twitter(Plugin):
             if data:
                 return OAuthUser(*data)
 
-    def get_user_api(self, oauth_user):
+    def get_user_api(self, user):
+        # Unconnected users are cached as None so that reactions from them
+        # don't hit the database either
+        try:
+            return self.user_apis[user.id]
+        except KeyError:
+            pass
+
+        oauth_user = self.get_user_oauth(user)
+        user_api = None if oauth_user is None else self.make_user_api(oauth_user)
+        self.user_apis[user.id] = user_api
+
+        return user_api
+
+    def make_user_api(self, oauth_user):
         oauth = OAuth(
             oauth_user.token,
             oauth_user.secret,
@@ -492,14 +514,12 @@ class Twitter(Plugin):
         )
 
     async def twitter_three_legged_action(self, tweet, channel, user, action, description):
-        oauth_user = self.get_user_oauth(user)
+        user_api = self.get_user_api(user)
 
-        if oauth_user is None:
+        if user_api is None:
             await self.inform_user_about_connections(user)
             return
 
-        user_api = self.get_user_api(oauth_user)
-
         try:
             action(user_api, tweet)
         except Exception as e:
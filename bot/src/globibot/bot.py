@@ -87,12 +87,22 @@ class Globibot(DiscordClient):
             '{} ({}) has joined the server "{}"'
                 .format(member.name, member.id, member.server.name)
         )
+        self._dispatch(Plugin.dispatch_member_join, member)
 
     async def on_member_remove(self, member):
         logger.debug(
             '{} ({}) has left the server "{}"'
                 .format(member.name, member.id, member.server.name)
         )
+        self._dispatch(Plugin.dispatch_member_remove, member)
+
+    async def on_server_join(self, server):
+        logger.debug('Joined the server "{}"'.format(server.name))
+        self._dispatch(Plugin.dispatch_server_join, server)
+
+    async def on_server_remove(self, server):
+        logger.debug('Left the server "{}"'.format(server.name))
+        self._dispatch(Plugin.dispatch_server_remove, server)
 
     async def on_member_update(self, before, after):
         self._dispatch(Plugin.dispatch_member_update, before, after)
@@ -1,43 +1,91 @@
-from queue import Queue
-from threading import Thread
+from threading import Thread, Semaphore
 
 import asyncio
 
 class AsyncIterator:
+    '''
+    Consumes a blocking iterable on a worker thread and hands its items to the
+    event loop as soon as they are produced
+    The worker blocks once MAX_PENDING items are waiting to be consumed
+    '''
 
-    POLL_INTERVAL = .5
+    MAX_PENDING = 256
 
-    def __init__(self):
-        self.queue = Queue()
+    END = object()
+
+    class Failure:
+
+        def __init__(self, exception):
+            self.exception = exception
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.slots = Semaphore(max_pending)
+        self.finished = asyncio.Future()
         self.thread = None
-        self.done = False
+        self.cancelled = False
         self.stop_iteration_cls = StopAsyncIteration
 
     def start(self, call, *args, **kwargs):
 
         def run():
-            for line in call(*args, **kwargs):
-                self.queue.put(line)
-            self.done = True
+            try:
+                for item in call(*args, **kwargs):
+                    self.slots.acquire()
+                    if self.cancelled:
+                        break
+                    self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+            except Exception as e:
+                self.loop.call_soon_threadsafe(
+                    self.queue.put_nowait,
+                    AsyncIterator.Failure(e)
+                )
+            finally:
+                self.loop.call_soon_threadsafe(self.finish)
 
-        self.thread = Thread(target=run)
+        self.thread = Thread(target=run, daemon=True)
         self.thread.start()
 
         return self
 
+    def finish(self):
+        self.queue.put_nowait(AsyncIterator.END)
+
+        if not self.finished.done():
+            self.finished.set_result(None)
+
     def throw(self, cls):
         self.stop_iteration_cls = cls
 
+    def cancel(self):
+        '''
+        Stops the worker at its next item, safe to call more than once and
+        after the iteration is over
+        '''
+        if self.cancelled:
+            return
+
+        self.cancelled = True
+        # Wakes the worker up if it is waiting for a free slot
+        self.slots.release()
+
     async def __aiter__(self):
         return self
 
     async def __anext__(self):
-        while self.queue.empty():
-            if self.done:
-                raise self.stop_iteration_cls
+        try:
+            item = await self.queue.get()
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+        if item is AsyncIterator.END:
+            self.queue.put_nowait(item)
+            raise self.stop_iteration_cls
 
-            await asyncio.sleep(AsyncIterator.POLL_INTERVAL)
+        if isinstance(item, AsyncIterator.Failure):
+            raise item.exception
 
-        item = self.queue.get()
-        self.queue.task_done()
+        self.slots.release()
         return item
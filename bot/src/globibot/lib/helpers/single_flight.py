@@ -0,0 +1,28 @@
+import asyncio
+
+class SingleFlight:
+    '''
+    Runs concurrent calls sharing a key only once, every caller awaits the
+    same result
+    A caller being cancelled does not cancel the call the others are waiting
+    for
+    '''
+
+    def __init__(self):
+        self.pending = dict()
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    async def run(self, key, call, *args, **kwargs):
+        try:
+            future = self.pending[key]
+        except KeyError:
+            future = asyncio.ensure_future(call(*args, **kwargs))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+
+        return await asyncio.shield(future)
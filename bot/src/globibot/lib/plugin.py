@@ -1,6 +1,7 @@
 from .errors import PluginException
 from .logging import logger
 from .helpers import formatting as f
+from .helpers.async_iterator import AsyncIterator
 from .transaction import Transaction
 from .decorators.validator import COMMAND_VALIDATORS_ATTR
 
@@ -91,15 +92,21 @@ class Plugin:
             content = f.code_block(formatted_lines[-lines:])
             await self.edit_message(message, content)
 
-        async for data in iterator:
-            text = formatter(data)
-            formatted_lines.append(text)
+        try:
+            async for data in iterator:
+                text = formatter(data)
+                formatted_lines.append(text)
 
-            if time() - started > every:
-                await update_stream()
-                started = time()
+                if time() - started > every:
+                    await update_stream()
+                    started = time()
 
-        await update_stream()
+            await update_stream()
+        finally:
+            # Otherwise the worker stays blocked on a full queue when we stop
+            # consuming early
+            if isinstance(iterator, AsyncIterator):
+                iterator.cancel()
 
     async def delete_message_after(self, message, seconds):
         await asyncio.sleep(seconds)
@@ -143,6 +150,18 @@ class Plugin:
     async def dispatch_member_update(self, before, after):
         await self.on_member_update(before, after)
 
+    async def dispatch_member_join(self, member):
+        await self.on_member_join(member)
+
+    async def dispatch_member_remove(self, member):
+        await self.on_member_remove(member)
+
+    async def dispatch_server_join(self, server):
+        await self.on_server_join(server)
+
+    async def dispatch_server_remove(self, server):
+        await self.on_server_remove(server)
+
     async def dispatch_reaction_add(self, reaction, user):
         await self.on_reaction_add(reaction, user)
 
@@ -164,6 +183,18 @@ class Plugin:
     async def on_member_update(self, before, after):
         pass
 
+    async def on_member_join(self, member):
+        pass
+
+    async def on_member_remove(self, member):
+        pass
+
+    async def on_server_join(self, server):
+        pass
+
+    async def on_server_remove(self, server):
+        pass
+
     async def on_reaction_add(self, reaction, user):
         pass
 
@@ -0,0 +1,2 @@
+alter table eval_environment
+    add column deterministic boolean not null default false;
@@ -0,0 +1,5 @@
+create table dj_media_info (
+    query       text    primary key,
+    infos       jsonb   not null,
+    resolved_at timestamp without time zone default (now() at time zone 'utc')
+);
@@ -0,0 +1,8 @@
+create table server_member (
+    server_id   bigint  not null,
+    author_id   bigint  not null,
+
+    primary key(server_id, author_id)
+);
+
+create index server_member_author_id on server_member (author_id);
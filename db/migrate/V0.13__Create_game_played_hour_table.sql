@@ -0,0 +1,9 @@
+create table game_played_hour (
+    server_id   bigint      not null,
+    name        text        not null,
+    hour        timestamp   without time zone   not null,
+    duration    int         not null,
+    sessions    int         not null,
+
+    primary key(server_id, name, hour)
+);
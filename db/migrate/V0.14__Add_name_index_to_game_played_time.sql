@@ -0,0 +1 @@
+create index game_played_time_name on game_played_time (name);